@@ -20,6 +20,7 @@ from .event import (
     Msg,
     RawMsg,
     ExpectMsg,
+    ignores_types,
     MustNotMsg,
     Block,
     ExpectTx,
@@ -55,6 +56,7 @@ from .runner import (
     remote_funding_pubkey,
     remote_funding_privkey,
 )
+from .async_runner import AsyncRunner, AsyncConn, NoiseTransport
 from .dummyrunner import DummyRunner
 from .namespace import (
     peer_message_namespace,
@@ -105,6 +107,7 @@ __all__ = [
     "Msg",
     "RawMsg",
     "ExpectMsg",
+    "ignores_types",
     "Block",
     "ExpectTx",
     "FundChannel",
@@ -123,6 +126,9 @@ __all__ = [
     "DummyRunner",
     "Runner",
     "Conn",
+    "AsyncRunner",
+    "AsyncConn",
+    "NoiseTransport",
     "KeySet",
     "peer_message_namespace",
     "namespace",
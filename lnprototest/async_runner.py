@@ -0,0 +1,499 @@
+#! /usr/bin/python3
+import asyncio
+import logging
+import struct
+import threading
+import time
+
+from concurrent import futures
+
+from pyln.proto.wire import (
+    LightningConnection,
+    PrivateKey,
+    PublicKey,
+    decryptWithAD,
+    encryptWithAD,
+)
+from .runner import Runner, Conn
+from .errors import EventError
+from .event import Event
+from .structure import Sequence
+from abc import abstractmethod
+from typing import Any, Coroutine, List, Optional, Union
+
+
+class NoiseTransport(object):
+    """BOLT #8 encrypted transport on top of asyncio streams.
+
+    The cryptography is the one of pyln.proto.wire.LightningConnection,
+    only the I/O is done on the event loop instead of a blocking socket.
+    """
+
+    # How long close() waits for the peer to acknowledge, before dropping
+    # the connection.
+    CLOSE_TIMEOUT = 5
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        lconn: LightningConnection,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.lconn = lconn
+        # Length of the message whose header we already decrypted, in
+        # case the read of the body got cancelled.
+        self.pending_length: Optional[int] = None
+
+    @classmethod
+    async def connect(
+        cls,
+        local_privkey: PrivateKey,
+        remote_pubkey: PublicKey,
+        host: str,
+        port: int,
+    ) -> "NoiseTransport":
+        """Open the connection and run the handshake as initiator"""
+        reader, writer = await asyncio.open_connection(host, port)
+        lconn = LightningConnection(None, remote_pubkey, local_privkey, True)
+        writer.write(lconn.handshake_act_one_initiator())
+        await writer.drain()
+        lconn.handshake_act_two_initiator(await reader.readexactly(50))
+        writer.write(lconn.handshake_act_three_initiator())
+        await writer.drain()
+        lconn.sck = lconn.chaining_key
+        lconn.rck = lconn.chaining_key
+        return cls(reader, writer, lconn)
+
+    async def read_message(self) -> bytes:
+        """Read and decrypt the next message.
+
+        It is safe to cancel this (e.g. by a timeout): the bytes are taken
+        from the stream only once the whole header or body is there."""
+        lconn = self.lconn
+        if self.pending_length is None:
+            lc = await self.reader.readexactly(18)
+            length = decryptWithAD(lconn.rk, lconn.nonce(lconn.rn), b"", lc)
+            self.pending_length = struct.unpack("!H", length)[0]
+            lconn.rn += 1
+
+        mc = await self.reader.readexactly(self.pending_length + 16)
+        self.pending_length = None
+        m = decryptWithAD(lconn.rk, lconn.nonce(lconn.rn), b"", mc)
+        lconn.rn += 1
+        assert lconn.rn % 2 == 0
+        lconn._maybe_rotate_keys()
+        return m
+
+    async def send_message(self, m: bytes) -> None:
+        lconn = self.lconn
+        length = struct.pack("!H", len(m))
+        lc = encryptWithAD(lconn.sk, lconn.nonce(lconn.sn), b"", length)
+        mc = encryptWithAD(lconn.sk, lconn.nonce(lconn.sn + 1), b"", m)
+        lconn.sn += 2
+        assert lconn.sn % 2 == 0
+        lconn._maybe_rotate_keys()
+        self.writer.write(lc + mc)
+        await self.writer.drain()
+
+    async def send_raw(self, data: bytes) -> None:
+        """Write bytes on the socket as they are, out of the encryption"""
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await asyncio.wait_for(self.writer.wait_closed(), self.CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Unsent data and all, we are done with it.
+            self.writer.transport.abort()
+        except (ConnectionError, OSError) as ex:
+            logging.debug(f"closing connection: {ex}")
+
+
+class AsyncConn(Conn):
+    """Connection whose transport lives on the runner event loop.
+
+    Once connected, a reader task decrypts the messages as they arrive
+    and queues them for the test. The queue is bounded: when it is full
+    the reader stops reading, and TCP pushes back on the node.
+
+    When the node hangs up the reader records why in closed_reason, and
+    from then on reads return None as soon as the queue is empty."""
+
+    MAX_QUEUED = 1024
+
+    def __init__(self, connprivkey: str):
+        super().__init__(connprivkey)
+        self.transport: Optional[NoiseTransport] = None
+        self.inbound: Optional["asyncio.Queue[Optional[bytes]]"] = None
+        self.reader_task: Optional["asyncio.Task[None]"] = None
+        self.closed_reason: Optional[str] = None
+
+    async def connect(self, host: str, port: int, node_id: str) -> None:
+        # FIXME: pyln.proto.wire should just use coincurve PrivateKey!
+        self.transport = await NoiseTransport.connect(
+            PrivateKey(bytes.fromhex(self.connprivkey.to_hex())),
+            PublicKey(bytes.fromhex(node_id)),
+            host,
+            port,
+        )
+        self.inbound = asyncio.Queue(maxsize=self.MAX_QUEUED)
+        self.reader_task = asyncio.get_running_loop().create_task(self.read_loop())
+
+    async def read_loop(self) -> None:
+        assert self.transport is not None and self.inbound is not None
+        try:
+            while True:
+                await self.inbound.put(await self.transport.read_message())
+        except asyncio.IncompleteReadError:
+            self.closed_reason = "EOF"
+        except ConnectionResetError:
+            self.closed_reason = "connection reset"
+        except Exception as ex:
+            self.closed_reason = str(ex) or type(ex).__name__
+        logging.debug(f"reader of {self} stopped: {self.closed_reason}")
+        # None tells the consumer there's nothing more to wait for.
+        await self.inbound.put(None)
+
+    def is_closed(self) -> bool:
+        """True once the node hung up and every message was consumed"""
+        return self.closed_reason is not None and self.pending_messages() == 0
+
+    def pending_messages(self) -> int:
+        """How many messages are already waiting to be consumed"""
+        return 0 if self.inbound is None else self.inbound.qsize()
+
+    async def next_message(self, timeout: float) -> Optional[bytes]:
+        """Next message from the node, or None on timeout or if the
+        connection is gone"""
+        assert self.inbound is not None
+        if self.is_closed():
+            return None
+        try:
+            return await asyncio.wait_for(self.inbound.get(), timeout)
+        except asyncio.TimeoutError:
+            logging.debug(f"timeout waiting for a message on {self}")
+            return None
+
+    async def close(self) -> None:
+        """Stop the reader and close the transport.  It can be called
+        again, e.g. by the teardown of the runner."""
+        task, self.reader_task = self.reader_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self.transport is not None and not self.transport.writer.is_closing():
+            await self.transport.close()
+
+
+class AsyncRunner(Runner):
+    """Abstract base class for runners doing their I/O with asyncio.
+
+    The runner owns an event loop running in a background thread.
+    Implementations write the async_* methods, while the synchronous
+    Runner API used by the events is implemented here by scheduling them
+    on the loop, so a single thread drives all the connections and a
+    timed out read is cancelled instead of leaving a thread blocked on
+    the socket.
+
+    Connecting (handshake included) and sending have a deadline of
+    io_timeout seconds: past it, the operation is cancelled on the loop
+    and the event fails.
+    """
+
+    io_timeout: float = 60
+
+    def __init__(self, config: Any):
+        super().__init__(config)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(
+            target=self.loop.run_forever, name="lnprototest-loop", daemon=True
+        )
+        self.loop_thread.start()
+
+    def run_coroutine(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        """Run coro on the runner loop, and wait for its result"""
+        fut = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return fut.result(timeout)
+        except futures.TimeoutError:
+            fut.cancel()
+            raise
+
+    def connect(self, event: Event, connprivkey: str) -> None:
+        try:
+            self.run_coroutine(self.async_connect(event, connprivkey), self.io_timeout)
+        except futures.TimeoutError:
+            raise EventError(
+                event, "Timed out connecting after {}s".format(self.io_timeout)
+            )
+
+    def recv(self, event: Event, conn: Conn, outbuf: bytes) -> None:
+        try:
+            self.run_coroutine(self.async_recv(event, conn, outbuf), self.io_timeout)
+        except futures.TimeoutError:
+            raise EventError(
+                event, "Timed out sending on {} after {}s".format(conn, self.io_timeout)
+            )
+
+    def get_output_message(
+        self, conn: Conn, event: Event, timeout: Optional[float] = None
+    ) -> Optional[bytes]:
+        return self.run_coroutine(self.async_get_output_message(conn, event, timeout))
+
+    async def run_async(self, events: Union[Sequence, List[Event], Event]) -> None:
+        """Run a whole test from a coroutine, without blocking its loop.
+
+        This is a thread offload, not an event loop driver: the events
+        are synchronous, so run() goes on in a thread of its own while
+        only its I/O runs on the runner loop.  Each test running at the
+        same time costs a thread, but not one of the default executor,
+        whose few workers would make the tests queue."""
+        loop = asyncio.get_running_loop()
+        done: "asyncio.Future[None]" = loop.create_future()
+
+        def _set_result() -> None:
+            if not done.done():
+                done.set_result(None)
+
+        def _set_exception(ex: BaseException) -> None:
+            if not done.done():
+                done.set_exception(ex)
+
+        def _run() -> None:
+            try:
+                self.run(events)
+            except BaseException as ex:
+                loop.call_soon_threadsafe(_set_exception, ex)
+            else:
+                loop.call_soon_threadsafe(_set_result)
+
+        threading.Thread(target=_run, name="lnprototest-run", daemon=True).start()
+        await done
+
+    async def __close_conns(self, conns: List[Conn]) -> None:
+        await asyncio.gather(
+            *(c.close() for c in conns if isinstance(c, AsyncConn)),
+            return_exceptions=True,
+        )
+
+    def teardown(self) -> None:
+        # stop() could have failed before closing them: their readers
+        # must not be left pending on a closed loop.
+        try:
+            self.run_coroutine(
+                self.__close_conns(list(self.conns.values())), self.io_timeout
+            )
+        except Exception as ex:
+            logging.debug(f"closing the connections: {ex}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        super().teardown()
+
+    @abstractmethod
+    async def async_connect(self, event: Event, connprivkey: str) -> None:
+        pass
+
+    @abstractmethod
+    async def async_recv(self, event: Event, conn: Conn, outbuf: bytes) -> None:
+        pass
+
+    @abstractmethod
+    async def async_get_output_message(
+        self, conn: Conn, event: Event, timeout: Optional[float] = None
+    ) -> Optional[bytes]:
+        pass
+
+
+def test_noise_transport() -> None:
+    from pyln.proto.wire import LightningServerSocket
+
+    server_key = PrivateKey(bytes([1] * 32))
+    server = LightningServerSocket(server_key)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+
+    def _echo() -> None:
+        lconn, _ = server.accept()
+        lconn.send_message(lconn.read_message())
+        lconn.connection.close()
+
+    thread = threading.Thread(target=_echo)
+    thread.start()
+
+    async def _client() -> None:
+        transport = await NoiseTransport.connect(
+            PrivateKey(bytes([2] * 32)),
+            server_key.public_key(),
+            "127.0.0.1",
+            server.getsockname()[1],
+        )
+        # Cancelling a read must not lose any byte.
+        try:
+            await asyncio.wait_for(transport.read_message(), 0.01)
+            assert False, "nothing was sent yet"
+        except asyncio.TimeoutError:
+            pass
+        await transport.send_message(b"\x00\x12hello")
+        assert await transport.read_message() == b"\x00\x12hello"
+        await transport.close()
+
+    asyncio.run(_client())
+    thread.join()
+    server.close()
+
+
+def test_async_conn() -> None:
+    from pyln.proto.wire import LightningServerSocket
+
+    server_key = PrivateKey(bytes([1] * 32))
+    server = LightningServerSocket(server_key)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+
+    def _send_and_hangup() -> None:
+        lconn, _ = server.accept()
+        for i in range(3):
+            lconn.send_message(bytes([0, 0x12, i]))
+        lconn.connection.close()
+
+    thread = threading.Thread(target=_send_and_hangup)
+    thread.start()
+
+    async def _client() -> None:
+        conn = AsyncConn("02")
+        await conn.connect(
+            "127.0.0.1",
+            server.getsockname()[1],
+            server_key.public_key().serializeCompressed().hex(),
+        )
+        for i in range(3):
+            assert await conn.next_message(5) == bytes([0, 0x12, i])
+        # The node hung up: no need to wait for the timeout.
+        assert await asyncio.wait_for(conn.next_message(60), 5) is None
+        assert conn.closed_reason == "EOF"
+        # ...and it stays so once the end of stream was consumed.
+        assert await asyncio.wait_for(conn.next_message(60), 1) is None
+        await conn.close()
+
+    asyncio.run(_client())
+    thread.join()
+    server.close()
+
+
+class _LocalRunner(AsyncRunner):
+    """A DummyRunner doing its I/O on the runner loop, with AsyncConns
+    to a local node when there is one"""
+
+    def __init__(self, node_port: Optional[int] = None, node_id: str = ""):
+        from .dummyrunner import DummyConfig
+
+        super().__init__(DummyConfig())
+        self.node_port = node_port
+        self.node_id = node_id
+
+    async def async_connect(self, event: Event, connprivkey: str) -> None:
+        conn = AsyncConn(connprivkey)
+        if self.node_port is not None:
+            await conn.connect("127.0.0.1", self.node_port, self.node_id)
+        self.add_conn(conn)
+
+    async def async_recv(self, event: Event, conn: Conn, outbuf: bytes) -> None:
+        pass
+
+    async def async_get_output_message(
+        self, conn: Conn, event: Event, timeout: Optional[float] = None
+    ) -> Optional[bytes]:
+        return None
+
+
+def _local_runner(node_port: Optional[int] = None, node_id: str = "") -> Runner:
+    from .dummyrunner import DummyRunner
+
+    # The I/O of the AsyncRunner, the rest of the DummyRunner
+    class Local(_LocalRunner, DummyRunner):
+        pass
+
+    return Local(node_port, node_id)
+
+
+def test_run_async() -> None:
+    from .event import Connect
+
+    # Both runs must be in it at the same time to get through
+    barrier = threading.Barrier(2, timeout=30)
+
+    class Meet(Event):
+        def action(self, runner: Runner) -> bool:
+            super().action(runner)
+            barrier.wait()
+            # Long enough for the loop of the caller to tick
+            time.sleep(0.1)
+            return True
+
+    class Fail(Event):
+        def action(self, runner: Runner) -> bool:
+            raise EventError(self, "failing on purpose")
+
+    async def _main(runners: List[Any]) -> None:
+        ticks = 0
+
+        async def _tick() -> None:
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.get_running_loop().create_task(_tick())
+        await asyncio.gather(
+            *(r.run_async([Connect(connprivkey="02"), Meet()]) for r in runners)
+        )
+        # The loop of the caller kept running meanwhile
+        assert ticks > 0
+        ticker.cancel()
+
+        try:
+            await runners[0].run_async([Fail()])
+            assert False, "the failure got lost"
+        except EventError as ex:
+            assert ex.message == "failing on purpose"
+
+    runners = [_local_runner(), _local_runner()]
+    asyncio.run(_main(runners))
+    for r in runners:
+        r.teardown()
+
+
+def test_teardown_open_conns() -> None:
+    from pyln.proto.wire import LightningServerSocket
+
+    server_key = PrivateKey(bytes([1] * 32))
+    server = LightningServerSocket(server_key)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    accepted = []
+    thread = threading.Thread(target=lambda: accepted.append(server.accept()))
+    thread.start()
+
+    runner = _local_runner(
+        server.getsockname()[1], server_key.public_key().serializeCompressed().hex()
+    )
+    runner.connect(Event(), "02")
+    conn = runner.conns["02"]
+    assert isinstance(conn, AsyncConn) and conn.reader_task is not None
+    task = conn.reader_task
+    # No stop(), as when it failed before closing the connections
+    runner.teardown()
+    assert task.cancelled()
+    assert conn.transport is not None and conn.transport.writer.is_closing()
+
+    thread.join()
+    accepted[0][0].connection.close()
+    server.close()
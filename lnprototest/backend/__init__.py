@@ -1,4 +1,5 @@
 from .backend import Backend
-from .bitcoind import Bitcoind
+from .bitcoind import Bitcoind, SharedBitcoind
+from .simbitcoind import SimBitcoind
 
-__all__ = ["Backend", "Bitcoind"]
+__all__ = ["Backend", "Bitcoind", "SharedBitcoind", "SimBitcoind"]
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+# Follow bitcoind through its ZMQ notifications, instead of polling it
+
+import logging
+import queue
+import threading
+import time
+
+from bitcoin.core import (
+    COutPoint,
+    CMutableTransaction,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    b2lx,
+)
+from typing import Any, Callable, List, Optional, Set
+
+try:
+    import zmq
+except ImportError:
+    # pyzmq is optional, without it the runners poll bitcoind.
+    zmq = None  # type: ignore
+
+
+class ZmqNotifier(object):
+    """Subscriber to the rawtx and hashblock notifications of bitcoind.
+
+    A background thread keeps the txids bitcoind accepted since the last
+    block and the hash of the tip, so the runners can wait for them on a
+    condition instead of dumping the mempool over and over.  bitcoind
+    also sends the transactions of each new block before its hash, so
+    the txids are forgotten at every block: a confirmed transaction
+    must not look like one which just entered the mempool."""
+
+    # How often the subscriber thread checks if it has to stop
+    POLL_MS = 200
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.txids: Set[str] = set()
+        self.tip: Optional[str] = None
+        self.cond = threading.Condition()
+        self.running = True
+        self.ctx: Any = None
+        self.sock = self._connect(endpoint)
+        self.thread = threading.Thread(
+            target=self.__run, name="lnprototest-zmq", daemon=True
+        )
+        self.thread.start()
+
+    def _connect(self, endpoint: str) -> Any:
+        """The socket subscribed to the notifications of endpoint"""
+        if zmq is None:
+            raise RuntimeError("ZMQ notifications need pyzmq")
+        self.ctx = zmq.Context()
+        sock = self.ctx.socket(zmq.SUB)
+        sock.setsockopt(zmq.SUBSCRIBE, b"rawtx")
+        sock.setsockopt(zmq.SUBSCRIBE, b"hashblock")
+        sock.connect(endpoint)
+        return sock
+
+    @staticmethod
+    def available() -> bool:
+        return zmq is not None
+
+    def alive(self) -> bool:
+        """False once the subscriber thread died, e.g. on a bad message:
+        nothing would wake up the waiters anymore"""
+        return self.thread.is_alive()
+
+    def __run(self) -> None:
+        try:
+            while self.running:
+                if not self.sock.poll(self.POLL_MS):
+                    continue
+                topic, body, _ = self.sock.recv_multipart()
+                with self.cond:
+                    if topic == b"rawtx":
+                        tx = CTransaction.deserialize(body)
+                        self.txids.add(b2lx(tx.GetTxid()))
+                    elif topic == b"hashblock":
+                        self.tip = body.hex()
+                        self.txids.clear()
+                    self.cond.notify_all()
+        except Exception as ex:
+            logging.warning(f"ZMQ subscriber stopped: {ex}")
+        finally:
+            # Let the waiters see that we are gone
+            with self.cond:
+                self.cond.notify_all()
+
+    def wait(self, predicate: Callable[[], bool], timeout: float) -> bool:
+        """Wait until predicate(), called under the lock, is true.
+        Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while not predicate():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.alive():
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def wait_for_tx(self, txid: str, timeout: float) -> bool:
+        """Wait for bitcoind to accept txid (hex, in the RPC byte order)"""
+        return self.wait(lambda: txid in self.txids, timeout)
+
+    def clear(self) -> None:
+        """Forget what was seen so far, e.g. when the chain is reset"""
+        with self.cond:
+            self.txids.clear()
+            self.tip = None
+
+    def close(self) -> None:
+        self.running = False
+        self.thread.join()
+        self.sock.close(linger=0)
+        if self.ctx is not None:
+            self.ctx.term()
+
+
+class _FakeSocket(object):
+    """Stands in for the SUB socket, fed by the test"""
+
+    def __init__(self) -> None:
+        self.messages: "queue.Queue[Any]" = queue.Queue()
+
+    def poll(self, timeout_ms: int) -> bool:
+        try:
+            item = self.messages.get(timeout=timeout_ms / 1000)
+        except queue.Empty:
+            return False
+        self.messages.queue.appendleft(item)
+        return True
+
+    def recv_multipart(self) -> List[bytes]:
+        item = self.messages.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def close(self, linger: int = 0) -> None:
+        pass
+
+
+def test_zmq_notifier() -> None:
+    sock = _FakeSocket()
+
+    class Notifier(ZmqNotifier):
+        def _connect(self, endpoint: str) -> Any:
+            return sock
+
+    tx = CMutableTransaction([CTxIn(COutPoint(bytes(32), 0))], [CTxOut(1000)])
+    txid = b2lx(tx.GetTxid())
+    notifier = Notifier("fake")
+    try:
+        assert not notifier.wait_for_tx(txid, 0.1)
+        sock.messages.put([b"rawtx", tx.serialize(), b"\x00"])
+        assert notifier.wait_for_tx(txid, 5)
+
+        # Once a block was found it is not news anymore
+        sock.messages.put([b"hashblock", bytes(32), b"\x01"])
+        assert notifier.wait(lambda: notifier.tip is not None, 5)
+        assert not notifier.wait_for_tx(txid, 0.1)
+
+        # A dead subscriber does not leave the waiters hanging
+        sock.messages.put(ValueError("garbage"))
+        notifier.thread.join(5)
+        assert not notifier.alive()
+        assert not notifier.wait_for_tx(txid, 30)
+    finally:
+        notifier.close()
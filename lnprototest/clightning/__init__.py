@@ -12,6 +12,54 @@ Important environment variables include TIMEOUT which sets how long we
 wait for responses (default, 30 seconds), and LIGHTNING_SRC which indicates
 where the binaries are (default ../lightning).
 
+Setting LNPROTOTEST_SNAPSHOT=1 saves the datadirs of lightningd and
+bitcoind right after the first start, and every restart() (e.g. between
+the TryAll passes) brings them back with a copy and a respawn of the
+daemons, instead of wiping everything and doing a cold start.
+
+When a connection is closed without expecting an error, the runner waits
+for the node to hang up; LNPROTOTEST_DRAIN_QUIET (default 5 seconds) is
+how long it waits for the next message before assuming that the node
+has nothing more to say but keeps the connection open.
+
+LNPROTOTEST_STANDBY=N keeps N nodes (a lightningd and its bitcoind, on
+a sandbox of their own) starting in the background, so that start() and
+restart() only have to swap in a node which is already up.  This takes
+precedence over LNPROTOTEST_SNAPSHOT on restart, when a standby is there.
+
+LNPROTOTEST_SHARED_BITCOIND=1 makes all the runners of the process use a
+single bitcoind, each with a wallet of its own, and resets the chain
+with invalidateblock instead of restarting bitcoind.  The runners of a
+process must then run one after the other, and LNPROTOTEST_SNAPSHOT is
+ignored (a snapshot would need to stop the shared bitcoind).
+
+LNPROTOTEST_BACKEND=sim replaces bitcoind with SimBitcoind, a simulated
+chain served from the test process itself (this takes precedence over
+LNPROTOTEST_SHARED_BITCOIND, since it is cheap to have one per runner).
+
+LNPROTOTEST_ZMQ=1 makes bitcoind publish its ZMQ notifications, so that
+expect_tx() waits for the transaction to be announced instead of polling
+the mempool.  It needs pyzmq and a bitcoind built with ZMQ support.
+
+The log of lightningd is kept in gzip segments under lightning-dir/logs,
+and only its last LNPROTOTEST_LOG_MEMORY bytes (default 8 MB) are kept in
+memory, to be printed when a test fails.  LNPROTOTEST_LOG_LEVEL (default
+debug) sets the --log-level of lightningd: e.g. info makes the passing
+runs cheaper.
+
+LNPROTOTEST_SANDBOX_ROOT sets where the runners create their directories
+(e.g. /dev/shm, to keep the datadirs in memory), the default is the
+system tmp dir.  They are removed by a background thread, and a runner
+that finds less than LNPROTOTEST_SANDBOX_MIN_FREE bytes (default 256 MB)
+free there waits for it to catch up.
+
+LNPROTOTEST_PARALLEL_TRYALL=N runs up to N passes of a test with TryAll
+at the same time: the first one on the runner of the test, the others in
+forked processes, each with a node of its own.  This needs the passes to
+be known upfront, so tests with a TryAll in a OneOf or an AnyOrder, or
+enabled depending on the node, are still run one pass after the other
+(as they are with LNPROTOTEST_SHARED_BITCOIND).
+
 """
 
 from .clightning import Runner
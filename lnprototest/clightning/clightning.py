@@ -4,23 +4,33 @@
 # Released by Rusty Russell under CC0:
 # https://creativecommons.org/publicdomain/zero/1.0/
 
+import atexit
 import hashlib
+import json
 import pyln.client
-import pyln.proto.wire
 import os
 import subprocess
+import threading
+import time
 import lnprototest
 import bitcoin.core
 import struct
 import shutil
 import logging
-import socket
-import time
 
-from contextlib import closing
 from datetime import date
 from concurrent import futures
-from lnprototest.backend import Bitcoind
+from lnprototest.backend import Bitcoind, SharedBitcoind, SimBitcoind
+from lnprototest.utils.fs_utils import (
+    cache_dir,
+    file_lock,
+    make_sandbox,
+    reap_tree,
+    replace_tree,
+)
+from lnprototest.utils.port_utils import reserve_port, release_port
+from lnprototest.utils.log_utils import LogSink
+from lnprototest.utils import copy_state
 from lnprototest import (
     Event,
     EventError,
@@ -31,90 +41,342 @@ from lnprototest import (
     MustNotMsg,
 )
 from lnprototest import wait_for
-from typing import Dict, Any, Callable, List, Optional, cast
+from typing import Dict, Any, Callable, List, Optional, Tuple, Union, cast
 
 TIMEOUT = int(os.getenv("TIMEOUT", "60"))
 LIGHTNING_SRC = os.path.join(os.getcwd(), os.getenv("LIGHTNING_SRC", "../lightning/"))
+SNAPSHOT = os.getenv("LNPROTOTEST_SNAPSHOT", "0") == "1"
+# How long check_final_error() waits for the node to either send
+# something or hang up, before assuming that nothing else is coming.
+DRAIN_QUIET = float(os.getenv("LNPROTOTEST_DRAIN_QUIET", "5"))
+# How many ready nodes to keep warm in the background, see _Standby.
+STANDBY = int(os.getenv("LNPROTOTEST_STANDBY", "0"))
+# Use the process wide bitcoind, see SharedBitcoind.
+SHARED_BITCOIND = os.getenv("LNPROTOTEST_SHARED_BITCOIND", "0") == "1"
+# "bitcoind", or "sim" for the in-process SimBitcoind.
+BACKEND = os.getenv("LNPROTOTEST_BACKEND", "bitcoind")
+# --log-level of lightningd
+LOG_LEVEL = os.getenv("LNPROTOTEST_LOG_LEVEL", "debug")
+
+BitcoinBackend = Union[Bitcoind, SharedBitcoind, SimBitcoind]
+
+
+# FIXME: Ask node for pubkey
+NODE_ID = "0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"
+
+# key == (path, size, mtime) of the binary, value == probe result
+_probes: Dict[Tuple[str, int, int], Dict[str, Any]] = {}
+
+
+def _run_probe(lightningd: str) -> Dict[str, Any]:
+    # Does it support (i.e. require!) --developer?
+    ret = subprocess.run(
+        [lightningd, "--developer", "--help"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    opts = (
+        subprocess.run(
+            [lightningd, "--list-features-only"],
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        .stdout.decode("utf-8")
+        .splitlines()
+    )
+    options: Dict[str, str] = {}
+    for o in opts:
+        if o.startswith("supports_"):
+            options[o] = "true"
+        else:
+            k, v = o.split("/")
+            options[k] = v
+    return {"developer": ret.returncode == 0, "options": options}
+
+
+def probe_lightningd(lightningd: str) -> Dict[str, Any]:
+    """What the lightningd binary supports: whether it takes --developer,
+    and its --list-features-only output.
+
+    Running the binary twice for every runner is expensive, so the result
+    is kept in the lnprototest cache, where it is shared by all the test
+    processes, keyed by the path, size, mtime and hash of the binary."""
+    st = os.stat(lightningd)
+    key = (os.path.realpath(lightningd), st.st_size, st.st_mtime_ns)
+    if key in _probes:
+        return _probes[key]
+
+    h = hashlib.sha256(repr(key).encode())
+    with open(lightningd, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    cache = os.path.join(cache_dir("lightningd-probe"), h.hexdigest())
+    with file_lock(cache + ".lock"):
+        try:
+            with open(cache) as f:
+                probe = json.load(f)
+        except (OSError, ValueError):
+            probe = _run_probe(lightningd)
+            with open(cache + ".tmp", "w") as f:
+                json.dump(probe, f)
+            os.replace(cache + ".tmp", cache)
+    _probes[key] = probe
+    return probe
+
+
+def _spawn_lightningd(
+    lightning_dir: str, port: int, bitcoind_port: int, flags: List[str]
+) -> Tuple[subprocess.Popen, pyln.client.LightningRpc, LogSink]:
+    """Launch lightningd on lightning_dir and wait until it is ready to
+    answer to RPC calls.
+
+    The log goes to the stdout of lightningd, which is drained by a
+    LogSink into lightning_dir/logs."""
+    proc = subprocess.Popen(
+        [
+            "{}/lightningd/lightningd".format(LIGHTNING_SRC),
+            "--lightning-dir={}".format(lightning_dir),
+            "--funding-confirms=3",
+            "--dev-force-privkey=0000000000000000000000000000000000000000000000000000000000000001",
+            "--dev-force-bip32-seed=0000000000000000000000000000000000000000000000000000000000000001",
+            "--dev-force-channel-secrets=0000000000000000000000000000000000000000000000000000000000000010/0000000000000000000000000000000000000000000000000000000000000011/0000000000000000000000000000000000000000000000000000000000000012/0000000000000000000000000000000000000000000000000000000000000013/0000000000000000000000000000000000000000000000000000000000000014/FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF",
+            "--dev-bitcoind-poll=1",
+            "--dev-fast-gossip",
+            "--dev-allow-localhost",
+            "--dev-no-htlc-timeout",
+            "--bind-addr=127.0.0.1:{}".format(port),
+            "--network=regtest",
+            "--bitcoin-rpcuser=rpcuser",
+            "--bitcoin-rpcpassword=rpcpass",
+            f"--bitcoin-rpcconnect=127.0.0.1:{bitcoind_port}",
+            "--log-level={}".format(LOG_LEVEL),
+            "--log-file=-",
+            "--htlc-maximum-msat=2000sat",
+        ]
+        + flags,
+        stdout=subprocess.PIPE,
+    )
+    assert proc.stdout
+    log_sink = LogSink(proc.stdout, os.path.join(lightning_dir, "logs"))
+    rpc = pyln.client.LightningRpc(
+        os.path.join(lightning_dir, "regtest", "lightning-rpc")
+    )
+
+    def node_ready(rpc: pyln.client.LightningRpc) -> bool:
+        try:
+            rpc.getinfo()
+            return True
+        except Exception as ex:
+            logging.debug(f"waiting for core-lightning: Exception received {ex}")
+            return False
+
+    try:
+        wait_for(lambda: node_ready(rpc), timeout=TIMEOUT)
+    except Exception:
+        proc.kill()
+        raise
+    logging.debug("Waited for core-lightning")
+    return proc, rpc, log_sink
+
+
+def _new_backend(directory: str, shared: bool = False) -> BitcoinBackend:
+    """The Bitcoin backend selected by LNPROTOTEST_BACKEND"""
+    if BACKEND == "sim":
+        return SimBitcoind(directory)
+    if BACKEND != "bitcoind":
+        raise ValueError("Unknown LNPROTOTEST_BACKEND {}".format(BACKEND))
+    if shared:
+        return SharedBitcoind(os.path.basename(directory))
+    return Bitcoind(directory)
+
+
+def _retire_node(
+    rpc: pyln.client.LightningRpc,
+    proc: subprocess.Popen,
+    bitcoind: BitcoinBackend,
+    port: int,
+) -> None:
+    """Stop a lightningd and its bitcoind, and give back their ports"""
+    try:
+        rpc.stop()
+        proc.wait(timeout=TIMEOUT)
+    except Exception as ex:
+        logging.debug(f"stopping lightningd: {ex}")
+        proc.kill()
+    _retire_backend(bitcoind)
+    release_port(port)
+
+
+def _retire_backend(bitcoind: BitcoinBackend) -> None:
+    """Stop a bitcoind, even one which did not finish to start, and give
+    back its port"""
+    try:
+        bitcoind.stop()
+    except Exception as ex:
+        logging.debug(f"stopping bitcoind: {ex}")
+        if isinstance(bitcoind, Bitcoind) and bitcoind.proc is not None:
+            bitcoind.proc.kill()
+    if isinstance(bitcoind, Bitcoind) and hasattr(bitcoind, "port"):
+        release_port(bitcoind.port)
+
+
+class _Standby(object):
+    """A bitcoind and a lightningd started on a sandbox of their own, in
+    the same state start() leaves a node in, waiting for a runner to take
+    them over.
+
+    With LNPROTOTEST_STANDBY=N the process keeps N of them warming up in
+    the background: start() and restart() hand over a ready node, and the
+    startup of the next one overlaps the test which is running."""
+
+    def __init__(self, flags: List[str]):
+        self.flags = flags
+        self.directory = make_sandbox("lnpt-cl-standby-")
+        self.lightning_dir = os.path.join(self.directory, "lightningd")
+        os.makedirs(self.lightning_dir)
+        self.lightning_port = reserve_port()
+        self.bitcoind = _new_backend(self.directory)
+        try:
+            self.bitcoind.start()
+            assert self.bitcoind.port is not None
+            self.proc, self.rpc, self.log_sink = _spawn_lightningd(
+                self.lightning_dir, self.lightning_port, self.bitcoind.port, flags
+            )
+        except Exception:
+            # Nobody will take over this one: don't leak the daemons and
+            # the ports of the half started node.
+            _retire_backend(self.bitcoind)
+            release_port(self.lightning_port)
+            reap_tree(self.directory)
+            raise
+        try:
+            # Make sure that we see any funds that come to our wallet
+            for i in range(5):
+                self.rpc.newaddr()
+        except Exception:
+            self.discard()
+            raise
+
+    def discard(self) -> None:
+        _retire_node(self.rpc, self.proc, self.bitcoind, self.lightning_port)
+        reap_tree(self.directory)
+
+
+_standby_lock = threading.Lock()
+# The startup flags of each standby, and the future building it
+_standbys: List[Tuple[List[str], "futures.Future[_Standby]"]] = []
+_standby_executor: Optional[futures.ThreadPoolExecutor] = None
+
+
+def _fill_standbys(flags: List[str]) -> None:
+    """Start building standbys until STANDBY of them match flags"""
+    global _standby_executor
+    with _standby_lock:
+        if _standby_executor is None:
+            # Room to retire the old nodes while the new ones warm up.
+            _standby_executor = futures.ThreadPoolExecutor(
+                max_workers=2 * STANDBY, thread_name_prefix="lnprototest-standby"
+            )
+            atexit.register(_discard_standbys)
+        # The flags of the runners change from test to test (e.g.
+        # add_startup_flag()): make room dropping the oldest ones.
+        while len(_standbys) >= 2 * STANDBY:
+            _standby_executor.submit(_discard_standby, _standbys.pop(0)[1])
+        matching = len([f for f, _ in _standbys if f == flags])
+        for i in range(STANDBY - matching):
+            _standbys.append(
+                (list(flags), _standby_executor.submit(_Standby, list(flags)))
+            )
 
 
-class CLightningConn(lnprototest.Conn):
-    def __init__(self, connprivkey: str, port: int):
-        super().__init__(connprivkey)
-        # FIXME: pyln.proto.wire should just use coincurve PrivateKey!
-        self.connection = pyln.proto.wire.connect(
-            pyln.proto.wire.PrivateKey(bytes.fromhex(self.connprivkey.to_hex())),
-            # FIXME: Ask node for pubkey
-            pyln.proto.wire.PublicKey(
-                bytes.fromhex(
-                    "0279be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798"
-                )
-            ),
-            "127.0.0.1",
-            port,
-        )
+def _has_standby(flags: List[str]) -> bool:
+    with _standby_lock:
+        return any(f == flags for f, _ in _standbys)
+
+
+def _take_standby(flags: List[str]) -> Optional[_Standby]:
+    """Pop a standby started with flags, waiting for it if it is still
+    warming up"""
+    with _standby_lock:
+        entry = next((e for e in _standbys if e[0] == flags), None)
+        if entry is None:
+            return None
+        _standbys.remove(entry)
+    try:
+        return entry[1].result()
+    except Exception as ex:
+        logging.warning(f"standby node failed to start: {ex}")
+        return None
+
+
+def _discard_standby(fut: "futures.Future[_Standby]") -> None:
+    try:
+        fut.result().discard()
+    except Exception as ex:
+        logging.debug(f"discarding standby: {ex}")
+
+
+def _discard_standbys() -> None:
+    with _standby_lock:
+        pending = [fut for _, fut in _standbys]
+        _standbys.clear()
+    for fut in pending:
+        _discard_standby(fut)
+
+
+def _forget_standbys() -> None:
+    # The standbys belong to the parent process: a forked process only
+    # runs one TryAll pass (see Runner.new_pass_runner()), without any.
+    global STANDBY, _standby_executor, _standby_lock
+    STANDBY = 0
+    _standbys.clear()
+    _standby_executor = None
+    _standby_lock = threading.Lock()
 
 
-class Runner(lnprototest.Runner):
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_standbys)
+
+
+class CLightningConn(lnprototest.AsyncConn):
+    """A peer connection to the core-lightning node"""
+
+
+class Runner(lnprototest.AsyncRunner):
     def __init__(self, config: Any):
         super().__init__(config)
         self.running = False
-        self.rpc = None
-        self.bitcoind = None
-        self.proc = None
+        # pyln.client has no type hints: its LightningRpc is Any anyway.
+        self.rpc: Any = None
+        # One of BitcoinBackend once started.  Which calls are valid
+        # depends on the backend (e.g. a shared one can't be halted), and
+        # the callers check it.
+        self.bitcoind: Any = None
+        self.proc: Optional[subprocess.Popen] = None
+        self.log_sink: Optional[LogSink] = None
         self.cleanup_callbacks: List[Callable[[], None]] = []
         self.fundchannel_future: Optional[Any] = None
         self.is_fundchannel_kill = False
         self.executor = futures.ThreadPoolExecutor(max_workers=20)
+        self.io_timeout = TIMEOUT
+        # Where the pristine datadirs are kept when snapshot is enabled
+        self.snapshot = SNAPSHOT
+        self.snapshot_dir: Optional[str] = None
+        # How many checkpoints were taken, to name their directory
+        self.checkpoints = 0
+        self.lightning_port: Optional[int] = None
+        # Sandboxes of the standbys we took over
+        self.standby_dirs: List[str] = []
 
         self.startup_flags = []
         for flag in config.getoption("runner_args"):
             self.startup_flags.append("--{}".format(flag))
 
-        # Does it support (i.e. require!) --developer?
-        ret = subprocess.Popen(
-            [
-                "{}/lightningd/lightningd".format(LIGHTNING_SRC),
-                "--developer",
-                "--help",
-            ],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-        if ret.returncode != 0:
+        probe = probe_lightningd("{}/lightningd/lightningd".format(LIGHTNING_SRC))
+        if probe["developer"]:
             self.startup_flags.append("--developer")
-
-        opts = (
-            subprocess.run(
-                [
-                    "{}/lightningd/lightningd".format(LIGHTNING_SRC),
-                    "--list-features-only",
-                ],
-                stdout=subprocess.PIPE,
-                check=True,
-            )
-            .stdout.decode("utf-8")
-            .splitlines()
-        )
-        self.options: Dict[str, str] = {}
-        for o in opts:
-            if o.startswith("supports_"):
-                self.options[o] = "true"
-            else:
-                k, v = o.split("/")
-                self.options[k] = v
-
-    def __reserve(self) -> int:
-        """
-        When python asks for a free port from the os, it is possible that
-        with concurrent access, the port that is picked is a port that is not free
-        anymore when we go to bind the daemon like bitcoind port.
-
-        Source: https://stackoverflow.com/questions/1365265/on-localhost-how-do-i-pick-a-free-port-number
-        """
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
-            s.bind(("", 0))
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            return s.getsockname()[1]
+        self.options: Dict[str, str] = dict(probe["options"])
 
     def __init_sandbox_dir(self) -> None:
         """Create the tmp directory for lnprotest and lightningd"""
@@ -140,61 +402,158 @@ class Runner(lnprototest.Runner):
     def is_running(self) -> bool:
         return self.running
 
+    def __spawn_lightningd(self) -> None:
+        """Launch lightningd on the current lightning_dir and wait until
+        it is ready to answer to RPC calls"""
+        assert self.lightning_port is not None
+        self.proc, self.rpc, self.log_sink = _spawn_lightningd(
+            self.lightning_dir,
+            self.lightning_port,
+            self.bitcoind.port,
+            self.startup_flags,
+        )
+        self.running = True
+        self.logger.debug("RUN core-lightning")
+
+    def __take_standby(self) -> bool:
+        """Swap the current node (if any) for a standby, returns False if
+        there is none for our startup flags"""
+        standby = _take_standby(self.startup_flags)
+        if standby is None:
+            return False
+        if self.proc is not None:
+            # Stopping it takes time too, get it off the critical path.
+            assert _standby_executor is not None and self.lightning_port is not None
+            _standby_executor.submit(
+                _retire_node, self.rpc, self.proc, self.bitcoind, self.lightning_port
+            )
+        self.standby_dirs.append(standby.directory)
+        self.lightning_dir = standby.lightning_dir
+        self.lightning_port = standby.lightning_port
+        self.bitcoind = standby.bitcoind
+        self.proc = standby.proc
+        self.rpc = standby.rpc
+        self.log_sink = standby.log_sink
+        # What it logged while waiting is not part of this test
+        self.log_sink.mark()
+        self.running = True
+        self.logger.debug("RUN core-lightning (standby)")
+        return True
+
     def start(self, also_bitcoind: bool = True) -> None:
         self.logger.debug("[START]")
+        if STANDBY > 0 and also_bitcoind and self.__take_standby():
+            _fill_standbys(self.startup_flags)
+            if self.snapshot and self.snapshot_dir is None:
+                self.__take_snapshot()
+            return
+
         self.__init_sandbox_dir()
-        self.lightning_port = self.__reserve()
+        if self.lightning_port is None:
+            self.lightning_port = reserve_port()
         if also_bitcoind:
-            self.bitcoind = Bitcoind(self.directory)
+            self.bitcoind = _new_backend(self.directory, shared=SHARED_BITCOIND)
             try:
                 self.bitcoind.start()
             except Exception as ex:
                 self.logger.debug(f"Exception with message {ex}")
             self.logger.debug("RUN Bitcoind")
-        self.proc = subprocess.Popen(
-            [
-                "{}/lightningd/lightningd".format(LIGHTNING_SRC),
-                "--lightning-dir={}".format(self.lightning_dir),
-                "--funding-confirms=3",
-                "--dev-force-privkey=0000000000000000000000000000000000000000000000000000000000000001",
-                "--dev-force-bip32-seed=0000000000000000000000000000000000000000000000000000000000000001",
-                "--dev-force-channel-secrets=0000000000000000000000000000000000000000000000000000000000000010/0000000000000000000000000000000000000000000000000000000000000011/0000000000000000000000000000000000000000000000000000000000000012/0000000000000000000000000000000000000000000000000000000000000013/0000000000000000000000000000000000000000000000000000000000000014/FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFF",
-                "--dev-bitcoind-poll=1",
-                "--dev-fast-gossip",
-                "--dev-allow-localhost",
-                "--dev-no-htlc-timeout",
-                "--bind-addr=127.0.0.1:{}".format(self.lightning_port),
-                "--network=regtest",
-                "--bitcoin-rpcuser=rpcuser",
-                "--bitcoin-rpcpassword=rpcpass",
-                f"--bitcoin-rpcconnect=127.0.0.1:{self.bitcoind.port}",
-                "--log-level=debug",
-                "--log-file=log",
-                "--htlc-maximum-msat=2000sat",
-            ]
-            + self.startup_flags
-        )
-        self.running = True
-        self.rpc = pyln.client.LightningRpc(
-            os.path.join(self.lightning_dir, "regtest", "lightning-rpc")
-        )
-        self.logger.debug("RUN core-lightning")
-
-        def node_ready(rpc: pyln.client.LightningRpc) -> bool:
-            try:
-                rpc.getinfo()
-                return True
-            except Exception as ex:
-                logging.debug(f"waiting for core-lightning: Exception received {ex}")
-                return False
-
-        wait_for(lambda: node_ready(self.rpc), timeout=TIMEOUT)
-        logging.debug("Waited for core-lightning")
+        self.__spawn_lightningd()
 
         # Make sure that we see any funds that come to our wallet
         for i in range(5):
             self.rpc.newaddr()
 
+        if STANDBY > 0:
+            _fill_standbys(self.startup_flags)
+        if self.snapshot and self.snapshot_dir is None and not SHARED_BITCOIND:
+            self.__take_snapshot()
+
+    def __halt_lightningd(self) -> None:
+        """Stop lightningd and wait for it to exit, so the datadir is
+        consistent on disk"""
+        assert self.proc is not None
+        self.rpc.stop()
+        self.proc.wait(timeout=TIMEOUT)
+        self.running = False
+
+    def __save_datadirs(self, snapshot_dir: str) -> None:
+        """Stop the daemons, copy their datadirs in snapshot_dir, and
+        start them again"""
+        self.__halt_lightningd()
+        self.bitcoind.halt()
+        replace_tree(
+            os.path.join(self.lightning_dir, "regtest"),
+            os.path.join(snapshot_dir, "lightningd"),
+        )
+        self.bitcoind.snapshot(os.path.join(snapshot_dir, "bitcoind"))
+        self.__restore_datadirs(snapshot_dir)
+
+    def __restore_datadirs(self, snapshot_dir: str) -> None:
+        """Respawn bitcoind and lightningd on top of the saved datadirs"""
+        replace_tree(
+            os.path.join(snapshot_dir, "lightningd"),
+            os.path.join(self.lightning_dir, "regtest"),
+        )
+        self.bitcoind.restore(os.path.join(snapshot_dir, "bitcoind"))
+        self.__spawn_lightningd()
+
+    def __take_snapshot(self) -> None:
+        """Save the datadirs of a freshly started node, so restart() can
+        bring them back instead of doing a cold start."""
+        self.logger.debug("[SNAPSHOT]")
+        snapshot_dir = os.path.join(self.directory, "snapshot")
+        self.__save_datadirs(snapshot_dir)
+        self.snapshot_dir = snapshot_dir
+
+    def __halt_for_restore(self) -> None:
+        """Stop everything, keeping the datadirs, before bringing back a
+        snapshot or a checkpoint"""
+        for cb in self.cleanup_callbacks:
+            cb()
+        self.__halt_lightningd()
+        for c in self.conns.values():
+            self.close_conn(c)
+        super().restart()
+        self.bitcoind.halt()
+
+    def supports_parallel_passes(self) -> bool:
+        # The runners sharing a bitcoind have to take turns.
+        shared = SHARED_BITCOIND and BACKEND == "bitcoind"
+        return not shared and super().supports_parallel_passes()
+
+    def new_pass_runner(self) -> "Runner":
+        runner = Runner(self.config)
+        runner.startup_flags = list(self.startup_flags)
+        # It runs a single pass, it would never restart from a snapshot.
+        runner.snapshot = False
+        return runner
+
+    def checkpoint(self) -> Optional[Any]:
+        # The sessions with the peers can't be saved, nor a shared bitcoind
+        # be stopped: this only works on a node without connections.
+        if (
+            self.conns
+            or self.fundchannel_future is not None
+            or isinstance(self.bitcoind, SharedBitcoind)
+        ):
+            return None
+        self.logger.debug("[CHECKPOINT]")
+        self.checkpoints += 1
+        checkpoint_dir = os.path.join(
+            self.directory, "checkpoint-{}".format(self.checkpoints)
+        )
+        self.__save_datadirs(checkpoint_dir)
+        return checkpoint_dir, copy_state(self.stash)
+
+    def restore_checkpoint(self, checkpoint: Any) -> bool:
+        self.logger.debug("[RESTORE CHECKPOINT]")
+        checkpoint_dir, stash = checkpoint
+        self.__halt_for_restore()
+        self.__restore_datadirs(checkpoint_dir)
+        self.stash = copy_state(stash)
+        return True
+
     def shutdown(self, also_bitcoind: bool = True) -> None:
         for cb in self.cleanup_callbacks:
             cb()
@@ -207,29 +566,83 @@ class Runner(lnprototest.Runner):
         self.shutdown(also_bitcoind=also_bitcoind)
         self.running = False
         for c in self.conns.values():
-            cast(CLightningConn, c).connection.connection.close()
-        if print_logs:
-            log_path = f"{self.lightning_dir}/regtest/log"
-            with open(log_path) as log:
-                self.logger.info("---------- core-lightning logging ----------------")
-                self.logger.info(log.read())
-                # now we make a backup of the log
-                shutil.copy(
-                    log_path,
-                    f'/tmp/c-lightning-log_{date.today().strftime("%b-%d-%Y_%H:%M:%S")}',
-                )
-        shutil.rmtree(os.path.join(self.lightning_dir, "regtest"))
+            self.close_conn(c)
+        if print_logs and self.log_sink is not None:
+            # lightningd is stopping, let the sink see the last lines
+            self.log_sink.close(timeout=TIMEOUT)
+            self.logger.info("---------- core-lightning logging ----------------")
+            self.logger.info("".join(self.log_sink.window()))
+            # now we make a backup of the whole (compressed) log
+            shutil.copytree(
+                self.log_sink.segment_dir,
+                f'/tmp/c-lightning-log_{date.today().strftime("%b-%d-%Y_%H:%M:%S")}',
+                dirs_exist_ok=True,
+            )
+        reap_tree(os.path.join(self.lightning_dir, "regtest"))
+
+    def teardown(self) -> None:
+        if self.lightning_port is not None:
+            release_port(self.lightning_port)
+            self.lightning_port = None
+        if isinstance(self.bitcoind, Bitcoind) and self.bitcoind.rpc is not None:
+            release_port(self.bitcoind.port)
+        elif isinstance(self.bitcoind, SimBitcoind) and self.bitcoind.port is not None:
+            self.bitcoind.stop()
+        for d in self.standby_dirs:
+            reap_tree(d)
+        super().teardown()
 
     def restart(self) -> None:
         self.logger.debug("[RESTART]")
+        if STANDBY > 0 and _has_standby(self.startup_flags):
+            for cb in self.cleanup_callbacks:
+                cb()
+            for c in self.conns.values():
+                self.close_conn(c)
+            super().restart()
+            if self.__take_standby():
+                _fill_standbys(self.startup_flags)
+                return
+            # It failed to start, go on with the usual way.
+
+        if self.snapshot_dir is not None:
+            self.__halt_for_restore()
+            self.__restore_datadirs(self.snapshot_dir)
+            return
+
         self.stop(also_bitcoind=False)
         # Make a clean start
         super().restart()
         self.bitcoind.restart()
         self.start(also_bitcoind=False)
 
-    def connect(self, _: Event, connprivkey: str) -> None:
-        self.add_conn(CLightningConn(connprivkey, self.lightning_port))
+    async def async_connect(self, _: Event, connprivkey: str) -> None:
+        conn = CLightningConn(connprivkey)
+        assert self.lightning_port is not None
+        await conn.connect("127.0.0.1", self.lightning_port, NODE_ID)
+        self.add_conn(conn)
+
+    def wait_for_peers(self, conns: List[Conn], timeout: float) -> None:
+        """Wait until lightningd lists all conns as connected peers.
+
+        This gives up silently after timeout: it's a readiness barrier,
+        whatever went wrong is up to the following events to catch."""
+
+        def _connected() -> bool:
+            peers = self.rpc.listpeers()["peers"]
+            connected = {p["id"] for p in peers if p["connected"]}
+            return all(c.pubkey.format().hex() in connected for c in conns)
+
+        try:
+            wait_for(_connected, timeout=timeout, interval=0.05)
+        except ValueError:
+            logging.debug(f"peers {conns} not connected after {timeout}s")
+
+    def wait_connect_ready(self, event: Event) -> None:
+        self.wait_for_peers(list(self.conns.values()), timeout=1)
+
+    def close_conn(self, conn: Conn) -> None:
+        self.run_coroutine(cast(CLightningConn, conn).close())
 
     def getblockheight(self) -> int:
         return self.bitcoind.rpc.getblockcount()
@@ -239,25 +652,40 @@ class Runner(lnprototest.Runner):
         self.bitcoind.rpc.invalidateblock(h)
 
     def add_blocks(self, event: Event, txs: List[str], n: int) -> None:
-        for tx in txs:
-            self.bitcoind.rpc.sendrawtransaction(tx)
-        self.bitcoind.rpc.generatetoaddress(n, self.bitcoind.rpc.getnewaddress())
-
-        wait_for(lambda: self.rpc.getinfo()["blockheight"] == self.getblockheight())
+        # One round trip for the txs and the address: the batch raises if
+        # one of the txs was rejected, before anything is mined.  A new
+        # address every time, otherwise after trim_blocks() bitcoind could
+        # mine again the very block it was told is invalid.
+        calls: List[Tuple[Any, ...]] = [("sendrawtransaction", tx) for tx in txs]
+        address = self.bitcoind.rpc.batch(calls + [("getnewaddress",)])[-1]
+        self.bitcoind.rpc.generatetoaddress(n, address)
+        self.wait_for_blockheight(event, self.getblockheight())
+
+    def wait_for_blockheight(self, event: Event, height: int) -> None:
+        """Block until lightningd has processed the block at height"""
+        if self.rpc.getinfo()["blockheight"] > height:
+            # Blocks were trimmed, and the node didn't see the reorg yet:
+            # waitblockheight would return immediately.
+            wait_for(
+                lambda: self.rpc.getinfo()["blockheight"] == height, timeout=TIMEOUT
+            )
+            return
+        try:
+            self.rpc.waitblockheight(height, TIMEOUT)
+        except pyln.client.RpcError as ex:
+            raise EventError(
+                event, "Node did not sync to block {}: {}".format(height, ex)
+            )
 
-    def recv(self, event: Event, conn: Conn, outbuf: bytes) -> None:
+    async def async_recv(self, event: Event, conn: Conn, outbuf: bytes) -> None:
+        clnconn = cast(CLightningConn, conn)
+        assert clnconn.transport is not None
         try:
-            cast(CLightningConn, conn).connection.send_message(outbuf)
-        except BrokenPipeError:
+            await clnconn.transport.send_message(outbuf)
+        except (BrokenPipeError, ConnectionResetError):
             # This happens when they've sent an error and closed; try
             # reading it to figure out what went wrong.
-            fut = self.executor.submit(
-                cast(CLightningConn, conn).connection.read_message
-            )
-            try:
-                msg = fut.result(1)
-            except futures.TimeoutError:
-                msg = None
+            msg = await clnconn.next_message(1)
             if msg:
                 raise EventError(
                     event, "Connection closed after sending {}".format(msg.hex())
@@ -336,7 +764,7 @@ class Runner(lnprototest.Runner):
         # when the core lightning node will go to fund the channel
         # but it will go to to connect with the node before
         # This required some more analysis from core lightning side
-        time.sleep(1)
+        self.wait_for_peers([conn], timeout=1)
 
         fut = self.executor.submit(
             _fundchannel, self, conn, amount, feerate, expect_fail
@@ -441,18 +869,12 @@ class Runner(lnprototest.Runner):
         }
         self.rpc.sendpay([routestep], payhash)
 
-    def get_output_message(
-        self, conn: Conn, event: Event, timeout: int = TIMEOUT
+    async def async_get_output_message(
+        self, conn: Conn, event: Event, timeout: Optional[float] = None
     ) -> Optional[bytes]:
-        fut = self.executor.submit(cast(CLightningConn, conn).connection.read_message)
-        try:
-            return fut.result(timeout)
-        except futures.TimeoutError as ex:
-            logging.error(f"timeout exception {ex}")
-            return None
-        except Exception as ex:
-            logging.error(f"{ex}")
-            return None
+        if timeout is None:
+            timeout = TIMEOUT
+        return await cast(CLightningConn, conn).next_message(timeout)
 
     def check_error(self, event: Event, conn: Conn) -> Optional[str]:
         # We get errors in form of err msgs, always.
@@ -470,12 +892,22 @@ class Runner(lnprototest.Runner):
         must_not_events: List[MustNotMsg],
     ) -> None:
         if not expected:
-            # Inject raw packet to ensure it hangs up *after* processing all previous ones.
-            cast(CLightningConn, conn).connection.connection.send(bytes(18))
-
+            cconn = cast(CLightningConn, conn)
+            if cconn.closed_reason is None and cconn.transport is not None:
+                # Inject raw packet to ensure it hangs up *after* processing all previous ones.
+                try:
+                    self.run_coroutine(cconn.transport.send_raw(bytes(18)))
+                except ConnectionError as ex:
+                    logging.debug(f"{conn} already gone: {ex}")
+
+            # The reader sees the hang up as soon as it happens, so this
+            # only waits the quiet period if the node keeps it open.
             while True:
-                binmsg = self.get_output_message(conn, event)
+                binmsg = self.get_output_message(conn, event, timeout=DRAIN_QUIET)
                 if binmsg is None:
+                    logging.debug(
+                        f"drained {conn}: {cconn.closed_reason or 'quiet period'}"
+                    )
                     break
                 for e in must_not_events:
                     if e.matches(binmsg):
@@ -488,27 +920,49 @@ class Runner(lnprototest.Runner):
                 if msgtype == namespace().get_msgtype("error").number:
                     raise EventError(event, "Got error msg: {}".format(binmsg.hex()))
 
-        cast(CLightningConn, conn).connection.connection.close()
+        self.close_conn(conn)
 
     def expect_tx(self, event: Event, txid: str) -> None:
         # Ah bitcoin endianness...
         revtxid = bitcoin.core.lx(txid).hex()
 
         # This txid should appear in the mempool.
+        def in_mempool() -> bool:
+            return revtxid in self.bitcoind.rpc.getrawmempool()
+
+        notifier = getattr(self.bitcoind, "notifier", None)
         try:
-            wait_for(lambda: revtxid in self.bitcoind.rpc.getrawmempool())
+            if notifier is None or not notifier.alive():
+                wait_for(in_mempool)
+            else:
+                # The mempool says for sure, the notifications just wake
+                # us up early: it could have been sent before we were
+                # listening, or the notifier could die meanwhile.
+                deadline = time.monotonic() + TIMEOUT
+                notified = False
+                while not in_mempool():
+                    if time.monotonic() > deadline:
+                        raise ValueError("{} not broadcast".format(revtxid))
+                    if notified or not notifier.alive():
+                        # Stale news, or nobody left to notify us: poll
+                        time.sleep(0.25)
+                    notified = notifier.wait_for_tx(revtxid, 1)
         except ValueError:
+            mempool = self.bitcoind.rpc.getrawmempool()
+            rawtxs = self.bitcoind.rpc.batch(
+                [("getrawtransaction", txid) for txid in mempool]
+            )
             raise EventError(
                 event,
                 "Did not broadcast the txid {}, just {}".format(
-                    revtxid,
-                    [
-                        (txid, self.bitcoind.rpc.getrawtransaction(txid))
-                        for txid in self.bitcoind.rpc.getrawmempool()
-                    ],
+                    revtxid, list(zip(mempool, rawtxs))
                 ),
             )
 
+    def event_started(self, event: Event) -> None:
+        if self.log_sink is not None:
+            self.log_sink.bookmark(event.name)
+
     def has_option(self, optname: str) -> Optional[str]:
         """Returns None if it doesn't support, otherwise 'even' or 'odd' (required or supported)"""
         if optname in self.options:
@@ -518,3 +972,19 @@ class Runner(lnprototest.Runner):
     def add_startup_flag(self, flag: str) -> None:
         logging.debug("[ADD STARTUP FLAG '{}']".format(flag))
         self.startup_flags.append("--{}".format(flag))
+
+
+def test_standby_failed_start(monkeypatch: Any) -> None:
+    from lnprototest.utils import port_utils
+
+    monkeypatch.setattr(f"{__name__}.BACKEND", "sim")
+    # There is no lightningd to spawn there.
+    monkeypatch.setattr(f"{__name__}.LIGHTNING_SRC", "/nonexistent")
+    leased = set(port_utils._leases)
+    try:
+        _Standby([])
+        assert False, "lightningd should have failed to start"
+    except FileNotFoundError:
+        pass
+    # The ports of bitcoind and lightningd went back to the pool
+    assert set(port_utils._leases) == leased
@@ -5,8 +5,8 @@ from .runner import Runner, Conn
 from .event import Event, ExpectMsg, MustNotMsg
 from typing import List, Optional
 from .keyset import KeySet
+from .utils import copy_state
 from pyln.proto.message import (
-    Message,
     FieldType,
     DynamicArrayType,
     EllipsisArrayType,
@@ -15,6 +15,14 @@ from pyln.proto.message import (
 from typing import Any
 
 
+class DummyConfig(object):
+    """Stands in for the pytest config, with every option off, to use a
+    DummyRunner outside of a pytest run (e.g. in the unit tests)"""
+
+    def getoption(self, name: str) -> bool:
+        return False
+
+
 class DummyRunner(Runner):
     def __init__(self, config: Any):
         super().__init__(config)
@@ -61,11 +69,38 @@ class DummyRunner(Runner):
             print("[RESTART]")
         self.blockheight = 102
 
+    def checkpoint(self) -> Optional[Any]:
+        # Everything is in memory, the conns only need their flags back.
+        return (
+            self.blockheight,
+            copy_state(self.stash),
+            dict(self.conns),
+            self.last_conn,
+            [
+                (c, c.expected_error, list(c.must_not_events))
+                for c in self.conns.values()
+            ],
+        )
+
+    def restore_checkpoint(self, checkpoint: Any) -> bool:
+        if self.config.getoption("verbose"):
+            print("[RESTORE CHECKPOINT]")
+        self.blockheight, stash, conns, self.last_conn, flags = checkpoint
+        self.stash = copy_state(stash)
+        self.conns = dict(conns)
+        for c, expected_error, must_not_events in flags:
+            c.expected_error = expected_error
+            c.must_not_events = list(must_not_events)
+        return True
+
     def connect(self, event: Event, connprivkey: str) -> None:
         if self.config.getoption("verbose"):
             print("[CONNECT {} {}]".format(event, connprivkey))
         self.add_conn(Conn(connprivkey))
 
+    def wait_connect_ready(self, event: Event) -> None:
+        pass
+
     def getblockheight(self) -> int:
         return self.blockheight
 
@@ -181,7 +216,7 @@ class DummyRunner(Runner):
             print("[GET_OUTPUT_MESSAGE {}]".format(conn))
 
         # We make the message they were expecting.
-        msg = Message(event.msgtype, **event.resolve_args(self, event.kwargs))
+        msg = event.build_message(self)
 
         # Fake up the other fields.
         for m in msg.missing_fields():
@@ -221,3 +256,51 @@ class DummyRunner(Runner):
 
     def teardown(self):
         pass
+
+
+def test_post_check_errors() -> None:
+    from .errors import EventError, SpecFileError
+    from .structure import Sequence
+
+    class FailingRunner(DummyRunner):
+        def __init__(self, failures: List[str]):
+            super().__init__(DummyConfig())
+            self.failures = failures
+
+        def check_final_error(
+            self,
+            event: Event,
+            conn: Conn,
+            expected: bool,
+            must_not_events: List[MustNotMsg],
+        ) -> None:
+            failure = self.failures[int(conn.name) - 2]
+            if failure == "event":
+                raise EventError(event, "conn {} hung up".format(conn.name))
+            if failure == "spec":
+                raise SpecFileError(event, "conn {} is wrong".format(conn.name))
+
+    def post_check(failures: List[str]) -> Exception:
+        runner = FailingRunner(failures)
+        for i in range(len(failures)):
+            runner.add_conn(Conn("0{}".format(i + 2)))
+        try:
+            runner.post_check(Sequence([]))
+        except Exception as ex:
+            assert runner.conns == {}
+            return ex
+        assert False, "post_check() did not fail"
+
+    # The broken spec is not wrapped into the failures of the node
+    ex = post_check(["event", "spec", "ok"])
+    assert isinstance(ex, SpecFileError)
+    assert ex.message == "conn 03 is wrong"
+
+    ex = post_check(["event", "ok", "event"])
+    assert isinstance(ex, EventError)
+    assert ex.message.startswith("2 connections failed: ")
+    assert "conn 02 hung up" in ex.message and "conn 04 hung up" in ex.message
+
+    ex = post_check(["ok", "event"])
+    assert isinstance(ex, EventError)
+    assert ex.message == "conn 03 hung up"
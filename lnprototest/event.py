@@ -1,6 +1,6 @@
 #! /usr/bin/python3
 import logging
-import traceback
+import sys
 import collections
 import os.path
 import io
@@ -8,9 +8,20 @@ import struct
 import time
 import json
 
-from typing import Optional, Dict, Union, Callable, Any, List, TYPE_CHECKING, overload
-
-from pyln.proto.message import Message
+from types import FrameType
+from typing import (
+    Optional,
+    Dict,
+    Union,
+    Callable,
+    Any,
+    List,
+    Tuple,
+    TYPE_CHECKING,
+    overload,
+)
+
+from pyln.proto.message import Message, MessageType
 
 from .errors import SpecFileError, EventError
 from .namespace import namespace
@@ -35,19 +46,37 @@ Resolvable = Union[Any, Callable[["Runner", "Event", str], Any]]
 class Event(object):
     """Abstract base class for events."""
 
+    # Events are named after the place they are created at, set this to
+    # False (on Event, or on a subclass) to skip it when generating lots
+    # of them.
+    capture_name = True
+
     def __init__(self) -> None:
-        # From help(traceback.extract_stack):
-        #   Each item in the list is a quadruple (filename,
-        #   line number, function name, text), and the entries are in order
-        #   from oldest to newest stack frame.
-        self.name = "unknown"
-        for s in reversed(traceback.extract_stack()):
+        self._name: Optional[str] = None
+        # Filename and line number we were created at, formatted into the
+        # name only if someone asks for it.
+        self._where: Optional[Tuple[str, int]] = None
+        if self.capture_name:
             # Ignore constructor calls, like this one.
-            if s[2] != "__init__":
-                self.name = "{}:{}:{}".format(
-                    type(self).__name__, os.path.basename(s[0]), s[1]
-                )
-                break
+            frame: Optional[FrameType] = sys._getframe(1)
+            while frame is not None and frame.f_code.co_name == "__init__":
+                frame = frame.f_back
+            if frame is not None:
+                self._where = (frame.f_code.co_filename, frame.f_lineno)
+
+    @property
+    def name(self) -> str:
+        if self._name is None:
+            if self._where is None:
+                return type(self).__name__
+            self._name = "{}:{}:{}".format(
+                type(self).__name__, os.path.basename(self._where[0]), self._where[1]
+            )
+        return self._name
+
+    @name.setter
+    def name(self, name: str) -> None:
+        self._name = name
 
     def enabled(self, runner: "Runner") -> bool:
         """Returns whether it should be enabled for this run.  Usually True"""
@@ -55,10 +84,17 @@ class Event(object):
 
     def action(self, runner: "Runner") -> bool:
         """action() returns the False if it needs to be called again"""
+        runner.event_started(self)
         if runner.config.getoption("verbose"):
             logging.info("# running {}:".format(self.to_json()))
         return True
 
+    def compile(self) -> None:
+        """Precompute whatever doesn't depend on the runner, so the
+        action() of every run doesn't have to.  Runner.run() calls this
+        before each run, so it must be cheap once done."""
+        pass
+
     def resolve_arg(self, fieldname: str, runner: "Runner", arg: Resolvable) -> Any:
         """If this is a string, return it, otherwise call it to get result"""
         if callable(arg):
@@ -80,7 +116,7 @@ class Event(object):
         event = self.name
         file_name = ""
         pos = ""
-        if len(toks) > 0:
+        if len(toks) > 2:
             event = toks[0]
             file_name = toks[1]
             pos = toks[2]
@@ -128,10 +164,10 @@ class Connect(Event):
             raise SpecFileError(
                 self, "Already have connection to {}".format(self.connprivkey)
             )
-        # This is a hack: if we've already got a connection, wait 1 second
-        # for gossip to be processed before connecting another one!
+        # If we've already got a connection, let the node process it
+        # (e.g. its gossip) before connecting another one!
         if len(runner.conns) != 0:
-            time.sleep(1)
+            runner.wait_connect_ready(self)
         runner.connect(self, self.connprivkey)
         return True
 
@@ -145,13 +181,15 @@ class MustNotMsg(PerConnEvent):
 
     def matches(self, binmsg: bytes) -> bool:
         msgnum = struct.unpack(">H", binmsg[0:2])[0]
-        msgtype = namespace().get_msgtype_by_number(msgnum)
-        if msgtype:
-            name = msgtype.name
-        else:
-            name = str(msgnum)
-        logging.debug(f"msg {name} != from what we are looking for {self.must_not}?")
-        return name == self.must_not
+        logging.debug(f"msg {msgnum} != from what we are looking for {self.must_not}?")
+        msgtype = namespace().get_msgtype(self.must_not)
+        if msgtype is not None:
+            return msgtype.number == msgnum
+        # Types unknown to the namespace go by number.
+        return (
+            self.must_not == str(msgnum)
+            and namespace().get_msgtype_by_number(msgnum) is None
+        )
 
     def action(self, runner: "Runner") -> bool:
         super().action(runner)
@@ -186,17 +224,44 @@ class Msg(PerConnEvent):
         if not self.msgtype:
             raise SpecFileError(self, "Unknown msgtype {}".format(msgtypename))
         self.kwargs = kwargs
+        # Filled by compile(), see compile_fields()
+        self.fields: Optional[Dict[str, Any]] = None
+        self.resolvable: Dict[str, Resolvable] = {}
+        # The encoded message, when none of the fields is resolvable
+        self.binmsg: Optional[bytes] = None
+
+    def compile(self) -> None:
+        if self.fields is not None:
+            return
+        self.fields, self.resolvable = compile_fields(self.msgtype, self.kwargs)
+        if not self.resolvable:
+            message = Message(self.msgtype, **self.fields)
+            if not message.missing_fields():
+                binmsg = io.BytesIO()
+                message.write(binmsg)
+                self.binmsg = binmsg.getvalue()
+
+    def build_message(self, runner: "Runner") -> Message:
+        """The message to send, with all the fields resolved"""
+        self.compile()
+        assert self.fields is not None
+        return Message(
+            self.msgtype, **self.fields, **self.resolve_args(runner, self.resolvable)
+        )
 
     def action(self, runner: "Runner") -> bool:
         super().action(runner)
         # Now we have runner, we can fill in all the message fields
-        message = Message(self.msgtype, **self.resolve_args(runner, self.kwargs))
-        missing = message.missing_fields()
-        if missing:
-            raise SpecFileError(self, "Missing fields {}".format(missing))
-        binmsg = io.BytesIO()
-        message.write(binmsg)
-        runner.recv(self, self.find_conn(runner), binmsg.getvalue())
+        message = self.build_message(runner)
+        binmsg = self.binmsg
+        if binmsg is None:
+            missing = message.missing_fields()
+            if missing:
+                raise SpecFileError(self, "Missing fields {}".format(missing))
+            buf = io.BytesIO()
+            message.write(buf)
+            binmsg = buf.getvalue()
+        runner.recv(self, self.find_conn(runner), binmsg)
         msg_to_stash(runner, self, message)
         return True
 
@@ -239,6 +304,28 @@ class RawMsg(PerConnEvent):
         return True
 
 
+IgnoreFn = Callable[[Message], Optional[List[Message]]]
+
+
+def ignores_types(*msgnums: int) -> Callable[[IgnoreFn], IgnoreFn]:
+    """Decorator declaring the message types an ignore function drops
+    whatever their content: those are dropped without being decoded."""
+
+    def _decorate(ignore: IgnoreFn) -> IgnoreFn:
+        ignore.ignored_types = frozenset(msgnums)  # type: ignore
+        return ignore
+
+    return _decorate
+
+
+def dropped_unread(ignore: IgnoreFn, binmsg: bytes) -> bool:
+    """Does ignore drop binmsg by its type alone? See ignores_types()"""
+    if len(binmsg) < 2:
+        return False
+    msgnum = struct.unpack(">H", binmsg[0:2])[0]
+    return msgnum in getattr(ignore, "ignored_types", ())
+
+
 class ExpectMsg(PerConnEvent):
     """Wait for a message from the runner.
 
@@ -248,6 +335,9 @@ class ExpectMsg(PerConnEvent):
     messages: it returns a list of messages to reply with, or None if the
     message should not be ignored: by default, it is ignore_gossip_queries.
 
+    The message types the ignore function declares with ignores_types()
+    are dropped as soon as their type is read, so they don't end up in
+    the stash.
     """
 
     def _default_if_match(self, msg: Message, runner: "Runner") -> None:
@@ -280,6 +370,7 @@ class ExpectMsg(PerConnEvent):
         return [outmsg]
 
     @staticmethod
+    @ignores_types(261, 263, 265)
     def ignore_gossip_queries(msg: Message) -> Optional[List[Message]]:
         """Ignore gossip_timestamp_filter, query_channel_range and query_short_channel_ids.  Respond to pings."""
         if msg.messagetype.name in (
@@ -291,6 +382,7 @@ class ExpectMsg(PerConnEvent):
         return ExpectMsg.ignore_pings(msg)
 
     @staticmethod
+    @ignores_types(*range(256, 512))
     def ignore_all_gossip(msg: Message) -> Optional[List[Message]]:
         """Ignore any gossip messages.  Respond to pings."""
         # BOLT #1: The messages are grouped logically into five
@@ -303,6 +395,7 @@ class ExpectMsg(PerConnEvent):
         return ExpectMsg.ignore_pings(msg)
 
     @staticmethod
+    @ignores_types(258)
     def ignore_channel_update(msg: Message) -> Optional[List[Message]]:
         """Ignore any channel update messages.  Respond to pings."""
         if msg.messagetype.number == 258:
@@ -313,7 +406,7 @@ class ExpectMsg(PerConnEvent):
         self,
         msgtypename: str,
         if_match: Callable[["ExpectMsg", Message, "Runner"], None] = _default_if_match,
-        ignore: Optional[Callable[[Message], Optional[List[Message]]]] = None,
+        ignore: Optional[IgnoreFn] = None,
         connprivkey: Optional[str] = None,
         **kwargs: Union[str, Resolvable],
     ):
@@ -327,12 +420,36 @@ class ExpectMsg(PerConnEvent):
         if ignore is None:
             ignore = self.ignore_gossip_queries
         self.ignore = ignore
+        # Filled by compile(), see compile_fields()
+        self.fields: Optional[Dict[str, Any]] = None
+        self.resolvable: Dict[str, Resolvable] = {}
+        # to_py() of the expected message, when none of the fields is
+        # resolvable
+        self.expected: Optional[Dict[str, Any]] = None
+
+    def compile(self) -> None:
+        if self.fields is not None:
+            return
+        self.fields, self.resolvable = compile_fields(self.msgtype, self.kwargs)
+        if not self.resolvable:
+            self.expected = Message(self.msgtype, **self.fields).to_py()
+
+    def build_message(self, runner: "Runner") -> Message:
+        """The (usually incomplete) message we expect, with all the
+        fields resolved"""
+        self.compile()
+        assert self.fields is not None
+        return Message(
+            self.msgtype, **self.fields, **self.resolve_args(runner, self.resolvable)
+        )
 
     def message_match(self, runner: "Runner", msg: Message) -> Optional[str]:
         """Does this message match what we expect?"""
-        partmessage = Message(self.msgtype, **self.resolve_args(runner, self.kwargs))
+        expected = self.expected
+        if expected is None:
+            expected = self.build_message(runner).to_py()
 
-        ret = cmp_msg(msg, partmessage)
+        ret = cmp_msg_obj(msg, self.msgtype, expected)
         if ret is None:
             self.if_match(self, msg, runner)
             msg_to_stash(runner, self, msg)
@@ -353,7 +470,9 @@ class ExpectMsg(PerConnEvent):
                     raise EventError(
                         self, "Got msg banned by {}: {}".format(e, binmsg.hex())
                     )
-            logging.debug(f"raw msg {''.join('%02x' % b for b in binmsg)}")
+            if dropped_unread(self.ignore, binmsg):
+                continue
+            logging.debug(f"raw msg {binmsg.hex()}")
             # Might be completely unknown to namespace.
             try:
                 msg = Message.read(namespace(), io.BytesIO(binmsg))
@@ -666,13 +785,32 @@ def cmp_obj(obj: Any, expected: Any, prefix: str) -> Optional[str]:
 
 def cmp_msg(msg: Message, expected: Message) -> Optional[str]:
     """Return None if every field in expected matches a field in msg.  Otherwise return a complaint"""
-    if msg.messagetype != expected.messagetype:
-        return "Expected {}, got {}".format(expected.messagetype, msg.messagetype)
+    return cmp_msg_obj(msg, expected.messagetype, expected.to_py())
 
-    obj = msg.to_py()
-    expected_obj = expected.to_py()
 
-    return cmp_obj(obj, expected_obj, expected.messagetype.name)
+def cmp_msg_obj(
+    msg: Message, messagetype: MessageType, expected_obj: Dict[str, Any]
+) -> Optional[str]:
+    """cmp_msg() against the to_py() of the expected message"""
+    if msg.messagetype != messagetype:
+        return "Expected {}, got {}".format(messagetype, msg.messagetype)
+
+    return cmp_obj(msg.to_py(), expected_obj, messagetype.name)
+
+
+def compile_fields(
+    msgtype: MessageType, kwargs: Dict[str, Resolvable]
+) -> Tuple[Dict[str, Any], Dict[str, Resolvable]]:
+    """Split the fields of a message event in the constant ones, already
+    converted from strings, and the ones to resolve at every run"""
+    resolvable = {k: v for k, v in kwargs.items() if callable(v)}
+    constant = {k: v for k, v in kwargs.items() if not callable(v)}
+    try:
+        return Message(msgtype, **constant).fields, resolvable
+    except ValueError:
+        # e.g. lengths only consistent with the resolved fields: leave
+        # it all for the run, which reports the error if there's one.
+        return {}, dict(kwargs)
 
 
 @overload
@@ -726,3 +864,90 @@ def negotiated(
         return True
 
     return _negotiated
+
+
+def test_compile_fields() -> None:
+    def _resolved(runner: "Runner", event: Event, field: str) -> int:
+        return 7
+
+    msg = Msg("ping", num_pong_bytes=_resolved, ignored="0000")
+    msg.compile()
+    assert msg.fields == {"ignored": [0, 0]}
+    assert list(msg.resolvable) == ["num_pong_bytes"]
+    assert msg.binmsg is None
+    assert msg.build_message(None).fields["num_pong_bytes"] == 7  # type: ignore
+
+    # All constant: encoded once for all.
+    msg = Msg("ping", num_pong_bytes=1, ignored="00")
+    msg.compile()
+    assert msg.binmsg == bytes.fromhex("001200010001" + "00")
+
+    from .dummyrunner import DummyConfig, DummyRunner
+
+    runner = DummyRunner(DummyConfig())
+    expect = ExpectMsg("ping", num_pong_bytes="1")
+    expect.compile()
+    assert expect.expected == {"num_pong_bytes": 1}
+    ping = Message(namespace().get_msgtype("ping"), num_pong_bytes=1, ignored="")
+    assert expect.message_match(runner, ping) is None
+    ping.set_field("num_pong_bytes", 2)
+    assert expect.message_match(runner, ping) == "ping.num_pong_bytes: 2 != 1"
+    runner.teardown()
+
+
+def test_event_name() -> None:
+    from .structure import Sequence
+
+    ping = Msg("ping", num_pong_bytes=1, ignored="")
+    assert ping.to_json() == {
+        "event": "Msg",
+        "file": "event.py",
+        "pos": str(sys._getframe().f_lineno - 4),
+    }
+    # Sequence(Sequence) keeps the name of the inner one
+    seq = Sequence([ping])
+    assert Sequence(seq).name == seq.name
+
+    Msg.capture_name = False
+    try:
+        assert Msg("ping", num_pong_bytes=1, ignored="").to_json() == {
+            "event": "Msg",
+            "file": "",
+            "pos": "",
+        }
+    finally:
+        Msg.capture_name = True
+
+
+def test_expectmsg_dropped_unread() -> None:
+    from .dummyrunner import DummyConfig, DummyRunner
+    from .runner import Conn
+
+    class ReplayRunner(DummyRunner):
+        def __init__(self, msgs: List[bytes]):
+            super().__init__(DummyConfig())
+            self.msgs = msgs
+
+        def get_output_message(
+            self, conn: "Conn", event: "ExpectMsg"
+        ) -> Optional[bytes]:
+            return self.msgs.pop(0) if self.msgs else None
+
+    # Not even a valid channel_update: it must not be decoded.
+    runner = ReplayRunner([bytes.fromhex("0102") + b"junk", bytes.fromhex("00130000")])
+    runner.add_conn(Conn("02"))
+    expect = ExpectMsg("pong", ignore=ExpectMsg.ignore_channel_update)
+    assert expect.action(runner)
+    assert "channel_update" not in runner.stash
+    assert "pong" in runner.stash
+
+    # Banned ones are still caught first.
+    runner.msgs = [bytes.fromhex("0102")]
+    MustNotMsg("channel_update").action(runner)
+    try:
+        expect.action(runner)
+        assert False, "channel_update was not banned"
+    except EventError:
+        pass
+    assert not MustNotMsg("ping").matches(bytes.fromhex("0013"))
+    runner.teardown()
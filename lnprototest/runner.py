@@ -1,22 +1,60 @@
 #! /usr/bin/python3
 import logging
-import shutil
-import tempfile
 import os
 import sys
 import time
 
 import coincurve
 import functools
+import multiprocessing
+
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
 
 from .bitfield import bitfield
-from .errors import SpecFileError
-from .structure import Sequence
+from .errors import EventError, SpecFileError
+from .structure import Sequence, plan_tryall_passes, set_tryall_state
 from .event import Event, MustNotMsg, ExpectMsg
 from .utils import privkey_expand
+from .utils.utils import get_traceback
+from .utils.fs_utils import make_sandbox, reap_tree, reaper
 from .keyset import KeySet
 from abc import ABC, abstractmethod
-from typing import Dict, Optional, List, Union, Any, Callable
+from typing import Dict, Optional, List, Union, Any, Callable, Tuple
+
+# How many TryAll passes can run at the same time: all of them but the
+# first one are run by forked processes, each with a runner of its own.
+PARALLEL_TRYALL = int(os.getenv("LNPROTOTEST_PARALLEL_TRYALL", "1"))
+
+# The test the pass workers run, they inherit it when they are forked.
+_pass_job: Optional[Tuple["Runner", Sequence, List[List[List[bool]]]]] = None
+
+
+def _run_pass(index: int) -> Optional[str]:
+    """Run a pass of _pass_job on a new runner, in a pass worker.
+
+    Returns None on success, or the error."""
+    assert _pass_job is not None
+    parent, sequence, plan = _pass_job
+    set_tryall_state(sequence, plan[index])
+    runner = parent.new_pass_runner()
+    try:
+        runner.start()
+        sequence.action(runner)
+        runner.post_check(sequence)
+        runner.stop()
+        return None
+    except Exception as ex:
+        logging.error(get_traceback(ex))
+        try:
+            runner.stop(print_logs=True)
+        except Exception as stop_ex:
+            logging.debug(f"stopping the runner of pass {index}: {stop_ex}")
+        return "pass {}: {}".format(index, ex)
+    finally:
+        runner.teardown()
+        # We are about to exit, without running atexit.
+        reaper().drain()
 
 
 class Conn(object):
@@ -44,11 +82,12 @@ class Runner(ABC):
 
     def __init__(self, config: Any):
         self.config = config
-        self.directory = tempfile.mkdtemp(prefix="lnpt-cl-")
+        self.directory = make_sandbox("lnpt-cl-")
         # key == connprivkey, value == Conn
         self.conns: Dict[str, Conn] = {}
         self.last_conn: Optional[Conn] = None
         self.stash: Dict[str, Dict[str, Any]] = {}
+        self.parallel_tryall = PARALLEL_TRYALL
         self.logger = logging.getLogger(__name__)
         if self.config.getoption("verbose"):
             self.logger.setLevel(logging.DEBUG)
@@ -82,30 +121,162 @@ class Runner(ABC):
         conn.expected_error = True
         return None
 
+    def wait_connect_ready(self, event: Event) -> None:
+        """Called by Connect when other connections are already open, to
+        give the node the time to process them (e.g. their gossip).
+
+        By default this sleeps one second: runners should override it to
+        wait only as long as the node actually needs."""
+        time.sleep(1)
+
+    def event_started(self, event: Event) -> None:
+        """Called as each event starts running, e.g. to find the lines of
+        the node log which belong to the one that failed."""
+        pass
+
     def post_check(self, sequence: Sequence) -> None:
-        # Make sure no connection had an error.
-        for conn_name in list(self.conns.keys()):
+        """Make sure no connection had an error.
+
+        The connections are checked concurrently, since each check can
+        wait for the node to hang up, and all the failures are reported
+        together."""
+        conns = list(self.conns.values())
+        for conn in conns:
             logging.debug(
-                f"disconnection connection with key={conn_name} and value={self.conns[conn_name]}"
+                f"disconnection connection with key={conn.name} and value={conn}"
+            )
+        if len(conns) <= 1:
+            for conn in conns:
+                self.disconnect(sequence, conn)
+            return
+
+        errors: List[BaseException] = []
+        with futures.ThreadPoolExecutor(max_workers=len(conns)) as executor:
+            for fut in [executor.submit(self.disconnect, sequence, c) for c in conns]:
+                ex = fut.exception()
+                if ex is not None:
+                    errors.append(ex)
+        # Anything but a failed check (e.g. a broken spec) is raised as it
+        # is, it must not be buried in the failures of the node.
+        unexpected = [e for e in errors if not isinstance(e, EventError)]
+        if unexpected:
+            raise unexpected[0]
+        if len(errors) == 1:
+            raise errors[0]
+        if errors:
+            raise EventError(
+                sequence,
+                "{} connections failed: {}".format(
+                    len(errors), "; ".join(str(e) for e in errors)
+                ),
             )
-            self.disconnect(sequence, self.conns[conn_name])
 
     def restart(self) -> None:
         self.conns = {}
         self.last_conn = None
         self.stash = {}
 
+    def checkpoint(self) -> Optional[Any]:
+        """Save the state of the runner and of the node, so a TryAll
+        pass can resume from here with restore_checkpoint() instead of
+        running the whole test again after restart().
+
+        Returns None if this is not possible at this point, which is
+        the default."""
+        return None
+
+    def restore_checkpoint(self, checkpoint: Any) -> bool:
+        """Bring back the state saved by checkpoint(), in place of restart().
+
+        Returns False if the runner can't, and did a restart() instead:
+        the events before the checkpoint must then run again.  This is
+        what the runners which don't override it do."""
+        self.restart()
+        return False
+
+    def supports_parallel_passes(self) -> bool:
+        """Whether the TryAll passes can run side by side, on the runners
+        returned by new_pass_runner()"""
+        return "fork" in multiprocessing.get_all_start_methods()
+
+    def new_pass_runner(self) -> "Runner":
+        """A runner like this one, to run a TryAll pass in a forked
+        process.  Runners with a state changed by the test (e.g. the
+        options of the node) must copy it here."""
+        return type(self)(self.config)
+
     # FIXME: Why can't we use SequenceUnion here?
     def run(self, events: Union[Sequence, List[Event], Event]) -> None:
         sequence = Sequence(events)
+        # Only the first run of the events does the work.
+        sequence.compile()
+        if self.parallel_tryall > 1 and self.supports_parallel_passes():
+            plan = plan_tryall_passes(sequence)
+            if plan is not None and len(plan) > 1:
+                self.__run_parallel(sequence, plan)
+                return
+
         self.start()
+        # Where the first TryAll is: the events before it are the same at
+        # every pass, so we try to run them only once.
+        path = sequence.tryall_path()
+        checkpoint = None
+        prefix_done = True
         while True:
-            all_done = sequence.action(self)
+            if path is None:
+                all_done = sequence.action(self)
+            else:
+                if checkpoint is None:
+                    prefix_done = sequence.action_until(self, path)
+                    checkpoint = self.checkpoint()
+                all_done = prefix_done & sequence.action_from(self, path)
             self.post_check(sequence)
             if all_done:
                 self.stop()
                 return
-            self.restart()
+            if checkpoint is None:
+                self.restart()
+            elif not self.restore_checkpoint(checkpoint):
+                checkpoint = None
+
+    def __run_parallel(self, sequence: Sequence, plan: List[List[List[bool]]]) -> None:
+        """Run the first pass here, while a pool of forked workers runs
+        the others, and fail with all the passes which failed."""
+        global _pass_job
+        _pass_job = (self, sequence, plan)
+        errors: List[str] = []
+        try:
+            ctx = multiprocessing.get_context("fork")
+            workers = min(self.parallel_tryall, len(plan)) - 1
+            with futures.ProcessPoolExecutor(workers, mp_context=ctx) as pool:
+                passes = [pool.submit(_run_pass, i) for i in range(1, len(plan))]
+                try:
+                    set_tryall_state(sequence, plan[0])
+                    self.start()
+                    sequence.action(self)
+                    self.post_check(sequence)
+                finally:
+                    # Even if this one failed, let the others finish.
+                    for index, fut in enumerate(passes, 1):
+                        try:
+                            error = fut.result()
+                        except BrokenProcessPool as ex:
+                            # A worker died (e.g. killed), instead of
+                            # waiting for its pass forever.
+                            error = "pass {}: {}".format(index, ex)
+                        if error is not None:
+                            self.logger.error(f"TryAll {error}")
+                            errors.append(error)
+        finally:
+            _pass_job = None
+        if errors:
+            raise EventError(
+                sequence,
+                "{} of {} TryAll passes failed: {}".format(
+                    len(errors), len(plan), "; ".join(errors)
+                ),
+            )
+        self.stop()
 
     def add_stash(self, stashname: str, vals: Any) -> None:
         """Add a dict to the stash."""
@@ -121,25 +292,10 @@ class Runner(ABC):
 
     def teardown(self):
         """The Teardown method is called at the end of the test,
-        and it is used to clean up the root dir where the tests are run."""
-        attempts = 3
-        for attempt in range(attempts):
-            try:
-                shutil.rmtree(self.directory, ignore_errors=True)
-                break
-            except PermissionError:
-                # On Windows, files might still be locked
-                if attempt < attempts - 1:
-                    # Wait a bit and retry
-                    self.logger.debug(f"Could not remove directory {self.directory}, retrying after delay...")
-                    time.sleep(1.0 * (attempt + 1))  # Increasing delay with each attempt
-                else:
-                    # Last attempt failed, just log the error
-                    self.logger.warning(f"Could not completely remove directory {self.directory} after {attempts} attempts")
-            except Exception as e:
-                # Other errors, just log
-                self.logger.warning(f"Error removing directory {self.directory}: {e}")
-                break
+        and it is used to clean up the root dir where the tests are run.
+
+        The directory is removed in background, see fs_utils.Reaper."""
+        reap_tree(self.directory)
 
     def runner_features(
         self,
@@ -1,12 +1,23 @@
 #! /usr/bin/python3
 import io
 import logging
+import os
 
-from .event import Event, ExpectMsg, ResolvableBool
+from .event import Event, ExpectMsg, ResolvableBool, dropped_unread
 from .errors import SpecFileError, EventError
 from .namespace import namespace
 from pyln.proto.message import Message
-from typing import Union, List, Optional, TYPE_CHECKING, cast
+from typing import (
+    Any,
+    Union,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TYPE_CHECKING,
+    cast,
+)
 
 if TYPE_CHECKING:
     # Otherwise a circular dependency
@@ -42,6 +53,10 @@ class Sequence(Event):
     def enabled(self, runner: "Runner") -> bool:
         return self.resolve_arg("enable", runner, self.enable)
 
+    def compile(self) -> None:
+        for e in self.events:
+            e.compile()
+
     def action(self, runner: "Runner", skip_first: bool = False) -> bool:
         super().action(runner)
         all_done = True
@@ -55,16 +70,91 @@ class Sequence(Event):
                 all_done &= e.action(runner)
         return all_done
 
+    def tryall_path(self) -> Optional[List[int]]:
+        """Indexes of the events leading to the first TryAll to run,
+        through plain Sequences.
+
+        The events before it run the same way at every pass, so the
+        runner can save its state there and resume from it.  None if
+        there's no TryAll, or if the first one is inside a OneOf or an
+        AnyOrder, or behind a Sequence enabled depending on the run,
+        where which events run depends on the node."""
+        for i, e in enumerate(self.events):
+            if not _contains_tryall(e):
+                continue
+            if isinstance(e, TryAll):
+                return [i]
+            if type(e) is not Sequence or callable(e.enable):
+                return None
+            if not e.enable:
+                continue
+            path = e.tryall_path()
+            return None if path is None else [i] + path
+        return None
+
+    def action_until(self, runner: "Runner", path: List[int]) -> bool:
+        """Run the events before the one at path, see tryall_path()"""
+        super().action(runner)
+        all_done = True
+        for e in self.events[: path[0]]:
+            logging.debug(f"receiving event {e}")
+            if e.enabled(runner):
+                all_done &= e.action(runner)
+        if len(path) > 1:
+            all_done &= cast(Sequence, self.events[path[0]]).action_until(
+                runner, path[1:]
+            )
+        return all_done
+
+    def action_from(self, runner: "Runner", path: List[int]) -> bool:
+        """Run the event at path and all the ones after it: together with
+        action_until() this is the same as action()"""
+        if len(path) > 1:
+            all_done = cast(Sequence, self.events[path[0]]).action_from(
+                runner, path[1:]
+            )
+        else:
+            all_done = self.events[path[0]].action(runner)
+        for e in self.events[path[0] + 1 :]:
+            logging.debug(f"receiving event {e}")
+            if e.enabled(runner):
+                all_done &= e.action(runner)
+        return all_done
+
     @staticmethod
     def ignored_by_all(
         msg: Message, sequences: List["Sequence"]
     ) -> Optional[List[Message]]:
+        # Usually they share the same ignore function: call it once.
+        ignores: List[Callable[[Message], Optional[List[Message]]]] = []
+        for s in sequences:
+            ignore = cast(ExpectMsg, s.events[0]).ignore
+            if ignore not in ignores:
+                ignores.append(ignore)
         # If they all say the same thing, that's the answer.
-        rets = [cast(ExpectMsg, s.events[0]).ignore(msg) for s in sequences]
+        rets = [ignore(msg) for ignore in ignores]
         if all([ignored == rets[0] for ignored in rets[1:]]):
             return rets[0]
         return None
 
+    @staticmethod
+    def dropped_unread_by_all(binmsg: bytes, sequences: List["Sequence"]) -> bool:
+        """Do they all drop binmsg by its type alone? See ignores_types()"""
+        return sequences != [] and all(
+            dropped_unread(cast(ExpectMsg, s.events[0]).ignore, binmsg)
+            for s in sequences
+        )
+
+    @staticmethod
+    def index_by_msgtype(sequences: List["Sequence"]) -> Dict[int, List["Sequence"]]:
+        """The sequences by the type number of the message they expect
+        first: a message can only match the ones under its own type."""
+        index: Dict[int, List[Sequence]] = {}
+        for s in sequences:
+            number = cast(ExpectMsg, s.events[0]).msgtype.number
+            index.setdefault(number, []).append(s)
+        return index
+
     @staticmethod
     def match_which_sequence(
         runner: "Runner", msg: Message, sequences: List["Sequence"]
@@ -95,6 +185,10 @@ class OneOf(Event):
         """Returns all enabled sequences"""
         return [s for s in self.sequences if s.enabled(runner)]
 
+    def compile(self) -> None:
+        for s in self.sequences:
+            s.compile()
+
     def action(self, runner: "Runner") -> bool:
         super().action(runner)
 
@@ -108,18 +202,22 @@ class OneOf(Event):
                 raise SpecFileError(self, "sequences do not all use the same conn?")
         assert conn
 
+        enabled = self.enabled_sequences(runner)
+        index = Sequence.index_by_msgtype(enabled)
         while True:
             event = self.sequences[0].events[0]
             binmsg = runner.get_output_message(conn, event)
             if binmsg is None:
                 raise EventError(self, f"Did not receive a message {event} from runner")
+            if Sequence.dropped_unread_by_all(binmsg, enabled):
+                continue
 
             try:
                 msg = Message.read(namespace(), io.BytesIO(binmsg))
             except ValueError as ve:
                 raise EventError(self, "Invalid msg {}: {}".format(binmsg.hex(), ve))
 
-            ignored = Sequence.ignored_by_all(msg, self.enabled_sequences(runner))
+            ignored = Sequence.ignored_by_all(msg, enabled)
             # If they gave us responses, send those now.
             if ignored is not None:
                 for msg in ignored:
@@ -129,7 +227,7 @@ class OneOf(Event):
                 continue
 
             seq = Sequence.match_which_sequence(
-                runner, msg, self.enabled_sequences(runner)
+                runner, msg, index.get(msg.messagetype.number, [])
             )
             if seq is not None:
                 # We found the sequence, run it
@@ -137,9 +235,7 @@ class OneOf(Event):
 
             raise EventError(
                 self,
-                "None of the sequences {} matched {}".format(
-                    self.enabled_sequences(runner), msg.to_str()
-                ),
+                "None of the sequences {} matched {}".format(enabled, msg.to_str()),
             )
 
 
@@ -159,6 +255,10 @@ class AnyOrder(Event):
         """Returns all enabled sequences"""
         return [s for s in self.sequences if s.enabled(runner)]
 
+    def compile(self) -> None:
+        for s in self.sequences:
+            s.compile()
+
     def action(self, runner: "Runner") -> bool:
         super().action(runner)
 
@@ -174,6 +274,7 @@ class AnyOrder(Event):
 
         all_done = True
         sequences = self.enabled_sequences(runner)
+        index = Sequence.index_by_msgtype(sequences)
         while sequences != []:
             # Get message
             binmsg = runner.get_output_message(conn, sequences[0].events[0])
@@ -185,12 +286,16 @@ class AnyOrder(Event):
                     ),
                 )
 
+            enabled = self.enabled_sequences(runner)
+            if Sequence.dropped_unread_by_all(binmsg, enabled):
+                continue
+
             try:
                 msg = Message.read(namespace(), io.BytesIO(binmsg))
             except ValueError as ve:
                 raise EventError(self, "Invalid msg {}: {}".format(binmsg.hex(), ve))
 
-            ignored = Sequence.ignored_by_all(msg, self.enabled_sequences(runner))
+            ignored = Sequence.ignored_by_all(msg, enabled)
             # If they gave us responses, send those now.
             if ignored is not None:
                 for msg in ignored:
@@ -199,9 +304,12 @@ class AnyOrder(Event):
                     runner.recv(self, conn, binm.getvalue())
                 continue
 
-            seq = Sequence.match_which_sequence(runner, msg, sequences)
+            seq = Sequence.match_which_sequence(
+                runner, msg, index.get(msg.messagetype.number, [])
+            )
             if seq is not None:
                 sequences.remove(seq)
+                index[msg.messagetype.number].remove(seq)
                 all_done &= seq.action(runner, skip_first=True)
                 continue
 
@@ -222,15 +330,20 @@ class TryAll(Event):
         self.sequences = [Sequence(s) for s in args]
         self.done = [False] * len(self.sequences)
 
-    def action(self, runner: "Runner") -> bool:
-        super().action(runner)
+    def compile(self) -> None:
+        for s in self.sequences:
+            s.compile()
 
+    def choose(self, enabled: List[bool]) -> Tuple[Optional[Sequence], bool]:
+        """Pick the sequence of this pass given which ones are enabled,
+        and mark it done.  Returns it (None if they are all disabled), and
+        whether every sequence has been done now."""
         # Take first undone one, or if that fails, first enabled one.
         first_enabled = None
         first_undone = None
         all_done = True
         for i, s in enumerate(self.sequences):
-            if not s.enabled(runner):
+            if not enabled[i]:
                 continue
             if not first_enabled:
                 first_enabled = s
@@ -243,14 +356,95 @@ class TryAll(Event):
                 all_done = False
 
         # Note: they might *all* be disabled!
-        if first_undone:
-            first_undone.action(runner)
-        elif first_enabled:
-            first_enabled.action(runner)
+        return first_undone or first_enabled, all_done
 
+    def action(self, runner: "Runner") -> bool:
+        super().action(runner)
+        seq, all_done = self.choose([s.enabled(runner) for s in self.sequences])
+        if seq is not None:
+            seq.action(runner)
         return all_done
 
 
+def _contains_tryall(event: Event) -> bool:
+    if isinstance(event, TryAll):
+        return True
+    if isinstance(event, Sequence):
+        return any(_contains_tryall(e) for e in event.events)
+    if isinstance(event, (OneOf, AnyOrder)):
+        return any(_contains_tryall(s) for s in event.sequences)
+    return False
+
+
+class _NotStatic(Exception):
+    """The TryAll passes depend on the run, see plan_tryall_passes()"""
+
+
+def _static_enable(seq: Sequence) -> bool:
+    if callable(seq.enable):
+        raise _NotStatic()
+    return bool(seq.enable)
+
+
+def _dry_run(event: Event) -> bool:
+    """Walk event as action() would, only making the TryAll choices"""
+    if isinstance(event, TryAll):
+        seq, all_done = event.choose([_static_enable(s) for s in event.sequences])
+        if seq is not None:
+            _dry_run(seq)
+        return all_done
+    if isinstance(event, Sequence):
+        all_done = True
+        for e in event.events:
+            if not _contains_tryall(e):
+                continue
+            if isinstance(e, Sequence) and not _static_enable(e):
+                continue
+            all_done &= _dry_run(e)
+        return all_done
+    if _contains_tryall(event):
+        # Inside a OneOf or an AnyOrder, the node decides.
+        raise _NotStatic()
+    return True
+
+
+def _tryalls(event: Event) -> List[TryAll]:
+    if isinstance(event, TryAll):
+        return [event] + [t for s in event.sequences for t in _tryalls(s)]
+    if isinstance(event, Sequence):
+        return [t for e in event.events for t in _tryalls(e)]
+    return []
+
+
+def plan_tryall_passes(sequence: Sequence) -> Optional[List[List[List[bool]]]]:
+    """The state of the TryAlls of sequence at the start of each of the
+    passes needed to run all of them, to be set with set_tryall_state().
+
+    None if it can't be known before running the test: a TryAll inside a
+    OneOf or an AnyOrder, or a Sequence with a resolvable enable deciding
+    which sequences the TryAlls take."""
+    tryalls = _tryalls(sequence)
+    saved = [list(t.done) for t in tryalls]
+    passes: List[List[List[bool]]] = []
+    try:
+        while True:
+            passes.append([list(t.done) for t in tryalls])
+            if _dry_run(sequence):
+                break
+    except _NotStatic:
+        return None
+    finally:
+        for t, done in zip(tryalls, saved):
+            t.done = done
+    return passes
+
+
+def set_tryall_state(sequence: Sequence, state: List[List[bool]]) -> None:
+    """Make the next action() of sequence run the pass of this state"""
+    for t, done in zip(_tryalls(sequence), state):
+        t.done = list(done)
+
+
 def test_empty_sequence() -> None:
     class nullrunner(object):
         class dummyconfig(object):
@@ -260,7 +454,137 @@ def test_empty_sequence() -> None:
         def __init__(self) -> None:
             self.config = self.dummyconfig()
 
+        def event_started(self, event: Event) -> None:
+            pass
+
     # This sequence should be tried twice.
     seq = Sequence(TryAll([], []))
     assert seq.action(nullrunner()) is False  # type: ignore
     assert seq.action(nullrunner()) is True  # type: ignore
+
+
+def test_tryall_checkpoint() -> None:
+    from .dummyrunner import DummyConfig, DummyRunner
+
+    class Count(Event):
+        def __init__(self) -> None:
+            super().__init__()
+            self.count = 0
+
+        def action(self, runner: "Runner") -> bool:
+            self.count += 1
+            runner.add_stash("count", self.count)
+            return True
+
+    prefix, inner, suffix = Count(), Count(), Count()
+    seq = Sequence(
+        [prefix, Sequence([Count(), TryAll([inner], [], [inner]), suffix]), Count()]
+    )
+    runner = DummyRunner(DummyConfig())
+    assert seq.tryall_path() == [1, 1]
+    runner.run(seq)
+    # The prefix ran only once, the rest once per pass
+    assert prefix.count == 1
+    assert inner.count == 2
+    assert suffix.count == 3
+    runner.teardown()
+
+    class ColdRunner(DummyRunner):
+        def restore_checkpoint(self, checkpoint: Any) -> bool:
+            # What the runners which can't do it get
+            return super(DummyRunner, self).restore_checkpoint(checkpoint)
+
+    # Restarted instead, the prefix runs again at every pass
+    prefix, inner, suffix = Count(), Count(), Count()
+    seq = Sequence(
+        [prefix, Sequence([Count(), TryAll([inner], [], [inner]), suffix]), Count()]
+    )
+    runner = ColdRunner(DummyConfig())
+    runner.run(seq)
+    assert prefix.count == 3
+    assert inner.count == 2
+    assert suffix.count == 3
+    runner.teardown()
+
+    assert Sequence([OneOf([TryAll([], [])])]).tryall_path() is None
+    assert Sequence([prefix]).tryall_path() is None
+    assert (
+        Sequence([Sequence(TryAll([], []), enable=lambda r, e, f: True)]).tryall_path()
+        is None
+    )
+
+
+def test_plan_tryall_passes() -> None:
+    from .dummyrunner import DummyConfig, DummyRunner
+
+    outer, inner = TryAll([], []), TryAll([], [], [])
+    seq = Sequence([outer, Sequence(inner)])
+    plan = plan_tryall_passes(seq)
+    assert plan == [
+        [[False, False], [False, False, False]],
+        [[True, False], [True, False, False]],
+        [[True, True], [True, True, False]],
+    ]
+    # Planning doesn't run anything
+    assert outer.done == [False, False]
+
+    set_tryall_state(seq, plan[2])
+    runner = DummyRunner(DummyConfig())
+    assert seq.action(runner) is True
+    runner.teardown()
+
+    assert plan_tryall_passes(Sequence([OneOf([TryAll([], [])])])) is None
+    disabled = Sequence([], enable=lambda r, e, f: False)
+    assert plan_tryall_passes(Sequence([TryAll(disabled, [])])) is None
+    assert plan_tryall_passes(Sequence([])) == [[]]
+
+
+def test_parallel_tryall() -> None:
+    from .dummyrunner import DummyConfig, DummyRunner
+
+    class Fail(Event):
+        def action(self, runner: "Runner") -> bool:
+            raise EventError(self, "failing on purpose")
+
+    runner = DummyRunner(DummyConfig())
+    runner.parallel_tryall = 3
+    runner.run(Sequence([TryAll([], [], [])]))
+
+    try:
+        runner.run(Sequence([TryAll([], [Fail()], [], [Fail()])]))
+        assert False, "the failing passes were not run"
+    except EventError as ex:
+        assert "2 of 4 TryAll passes failed" in str(ex)
+        assert "pass 1:" in str(ex) and "pass 3:" in str(ex)
+
+    class Crash(Event):
+        def action(self, runner: "Runner") -> bool:
+            # The worker dies without reporting anything
+            os._exit(1)
+
+    try:
+        runner.run(Sequence([TryAll([], [Crash()])]))
+        assert False, "the crash of the worker went unnoticed"
+    except EventError as ex:
+        assert "1 of 2 TryAll passes failed" in str(ex)
+    runner.teardown()
+
+
+def test_index_by_msgtype() -> None:
+    calls = []
+
+    def _ignore(msg: Message) -> Optional[List[Message]]:
+        calls.append(msg)
+        return ExpectMsg.ignore_pings(msg)
+
+    ping, pong = ExpectMsg("ping", ignore=_ignore), ExpectMsg("pong", ignore=_ignore)
+    ping2 = ExpectMsg("ping", ignore=_ignore)
+    seqs = [Sequence(ping), Sequence(pong), Sequence(ping2)]
+    index = Sequence.index_by_msgtype(seqs)
+    assert index == {18: [seqs[0], seqs[2]], 19: [seqs[1]]}
+
+    # The shared ignore function runs once, and its reply is used.
+    msg = Message(namespace().get_msgtype("ping"), num_pong_bytes=1, ignored="")
+    reply = Sequence.ignored_by_all(msg, seqs)
+    assert reply is not None and reply[0].messagetype.name == "pong"
+    assert calls == [msg]
@@ -14,6 +14,7 @@ from .utils import (
     check_hex,
     privkey_for_index,
     merge_events_sequences,
+    copy_state,
 )
 from .bitcoin_utils import (
     ScriptType,
@@ -0,0 +1,254 @@
+"""
+Filesystem utils used by the runners to manage the node data directories.
+"""
+
+import atexit
+import os
+import queue
+import shutil
+import stat
+import logging
+import tempfile
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, no reflink support.
+    fcntl = None  # type: ignore
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+CACHE_DIR = os.getenv(
+    "LNPROTOTEST_CACHE_DIR", os.path.join(tempfile.gettempdir(), "lnprototest-cache")
+)
+
+
+# Where the runners create their sandboxes, e.g. /dev/shm to keep the
+# datadirs of the daemons in memory. Default is the system tmp dir.
+SANDBOX_ROOT = os.getenv("LNPROTOTEST_SANDBOX_ROOT") or None
+# Free bytes make_sandbox() wants on SANDBOX_ROOT, waiting for the reaper
+# to make room if needed.
+SANDBOX_MIN_FREE = int(os.getenv("LNPROTOTEST_SANDBOX_MIN_FREE", str(256 << 20)))
+
+
+def cache_dir(*paths: str) -> str:
+    """Return (and create) a directory inside the lnprototest cache, this
+    is shared by all the test processes running on the machine."""
+    path = os.path.join(CACHE_DIR, *paths)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextmanager
+def file_lock(path: str, shared: bool = False) -> Iterator[None]:
+    """Hold a cross process lock on the file at path.
+
+    On platforms without flock() this is a noop."""
+    with open(path, "a") as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def _reflink(src: str, dst: str) -> bool:
+    """Try to make dst a copy-on-write clone of src, return False
+    if the filesystem does not support it."""
+    if fcntl is None:
+        return False
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def clone_file(src: str, dst: str) -> None:
+    """Copy a single file, using a reflink when the filesystem allows it.
+
+    Hardlinks are not an option here, the databases of lightningd and
+    bitcoind are rewritten in place, so a hardlink would end up
+    modifying the snapshot too."""
+    if not _reflink(src, dst):
+        shutil.copy2(src, dst)
+
+
+def clone_tree(src: str, dst: str, ignore: Optional[List[str]] = None) -> None:
+    """Clone the directory src in dst, where dst must not exist.
+
+    Special files (e.g. the lightning-rpc unix socket) are skipped, they
+    are recreated by the daemon at startup anyway."""
+    ignore = ignore or []
+    os.makedirs(dst)
+    for entry in os.scandir(src):
+        if entry.name in ignore:
+            continue
+        src_path = os.path.join(src, entry.name)
+        dst_path = os.path.join(dst, entry.name)
+        mode = entry.stat(follow_symlinks=False).st_mode
+        if stat.S_ISDIR(mode):
+            clone_tree(src_path, dst_path)
+        elif stat.S_ISREG(mode):
+            clone_file(src_path, dst_path)
+        else:
+            logging.debug(f"clone_tree: skipping special file {src_path}")
+
+
+def replace_tree(src: str, dst: str, ignore: Optional[List[str]] = None) -> None:
+    """Replace the content of dst with a clone of src"""
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    clone_tree(src, dst, ignore)
+
+
+def tree_size(path: str) -> int:
+    """Bytes used by the regular files under path"""
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class Reaper(object):
+    """Removes directories in a background thread.
+
+    Removing the datadir of a daemon can take a while (and on Windows
+    it can fail while the files are still open), so reap() only renames
+    it away, and the next test can start while it is being deleted."""
+
+    ATTEMPTS = 3
+
+    def __init__(self) -> None:
+        self.queue: "queue.Queue[str]" = queue.Queue()
+        self.lock = threading.Lock()
+        # Bytes removed so far
+        self.reaped_bytes = 0
+        self.thread = threading.Thread(
+            target=self.__run, name="lnprototest-reaper", daemon=True
+        )
+        self.thread.start()
+
+    def reap(self, path: str) -> None:
+        """Remove path in background, path is free for reuse on return"""
+        if not os.path.exists(path):
+            return
+        doomed = "{}.reap-{}".format(path, uuid.uuid4().hex[:8])
+        try:
+            os.rename(path, doomed)
+        except OSError as ex:
+            logging.debug(f"Could not rename {path} ({ex}), removing it in place")
+            doomed = path
+        self.queue.put(doomed)
+
+    def __remove(self, path: str) -> None:
+        for attempt in range(self.ATTEMPTS):
+            try:
+                shutil.rmtree(path)
+                return
+            except FileNotFoundError:
+                return
+            except PermissionError:
+                # On Windows, files might still be locked
+                time.sleep(1.0 * (attempt + 1))
+            except Exception as ex:
+                logging.warning(f"Error removing directory {path}: {ex}")
+                return
+        logging.warning(f"Could not completely remove directory {path}")
+
+    def __run(self) -> None:
+        while True:
+            path = self.queue.get()
+            size = tree_size(path)
+            self.__remove(path)
+            with self.lock:
+                self.reaped_bytes += size
+            logging.debug(f"Reaped {path}, {size} bytes")
+            self.queue.task_done()
+
+    def drain(self) -> None:
+        """Wait until everything reaped so far is gone"""
+        self.queue.join()
+
+
+_reaper: Optional[Reaper] = None
+_reaper_lock = threading.Lock()
+
+
+def reaper() -> Reaper:
+    """The reaper of the process, started on first use"""
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = Reaper()
+            # Don't leave half removed directories behind.
+            atexit.register(_reaper.drain)
+        return _reaper
+
+
+def _forget_reaper() -> None:
+    # The thread of the reaper doesn't survive fork(), the child starts
+    # its own on first use.
+    global _reaper, _reaper_lock
+    _reaper = None
+    _reaper_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_reaper)
+
+
+def reap_tree(path: str) -> None:
+    """Remove the directory at path in background"""
+    reaper().reap(path)
+
+
+def make_sandbox(prefix: str) -> str:
+    """Create a fresh directory for a runner or a daemon under
+    SANDBOX_ROOT.
+
+    If the sandbox root is short of space (e.g. a tmpfs), wait for the
+    reaper to give it back first."""
+    if SANDBOX_ROOT is not None:
+        os.makedirs(SANDBOX_ROOT, exist_ok=True)
+    root = SANDBOX_ROOT or tempfile.gettempdir()
+    if shutil.disk_usage(root).free < SANDBOX_MIN_FREE and _reaper is not None:
+        logging.debug(f"{root} is almost full, waiting for the reaper")
+        _reaper.drain()
+    return tempfile.mkdtemp(prefix=prefix, dir=SANDBOX_ROOT)
+
+
+def test_reap_tree() -> None:
+    sandbox = make_sandbox("lnpt-test-")
+    datadir = os.path.join(sandbox, "datadir")
+    os.makedirs(os.path.join(datadir, "sub"))
+    with open(os.path.join(datadir, "sub", "file"), "wb") as f:
+        f.write(bytes(1000))
+
+    before = reaper().reaped_bytes
+    reap_tree(datadir)
+    # The name is free right away, e.g. to start over on the same path.
+    assert not os.path.exists(datadir)
+    os.makedirs(datadir)
+
+    reaper().drain()
+    assert reaper().reaped_bytes - before == 1000
+    assert os.listdir(sandbox) == ["datadir"]
+    reap_tree(sandbox)
+    reaper().drain()
+    assert not os.path.exists(sandbox)
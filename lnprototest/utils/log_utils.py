@@ -0,0 +1,228 @@
+"""
+Bounded capture of the logs of the daemons under test.
+
+A daemon logging at debug level can write hundreds of MB during a long
+gossip test: instead of a log file read back whole at the end, its
+output is read from a pipe by a background thread, which keeps the last
+lines in memory (up to a budget of bytes) and writes everything to
+gzip compressed segments on disk.
+"""
+
+import collections
+import gzip
+import itertools
+import os
+import threading
+import logging
+
+from typing import IO, Deque, List, Optional, Tuple
+
+# Bytes of log lines kept in memory
+LOG_MEMORY = int(os.getenv("LNPROTOTEST_LOG_MEMORY", str(8 << 20)))
+# Uncompressed bytes written to a segment before starting the next one
+LOG_SEGMENT = int(os.getenv("LNPROTOTEST_LOG_SEGMENT", str(32 << 20)))
+
+# Numbers the sinks of the process, for the names of their segments
+_sink_ids = itertools.count()
+
+
+class LogSink(object):
+    """Drain the log of a daemon from stream.
+
+    mark() starts a new window (e.g. a new pass of the test), and
+    window() gives the lines written since then, which are the ones
+    worth showing when the test fails.  bookmark() notes where each
+    event starts, so the window shows where the failing one began.
+
+    The daemon must never block on a full pipe: if the segments can't
+    be written, or the lines can't be kept, the rest of the output is
+    read and dropped."""
+
+    def __init__(
+        self,
+        stream: IO[bytes],
+        segment_dir: str,
+        max_memory: int = LOG_MEMORY,
+        segment_size: int = LOG_SEGMENT,
+    ):
+        self.stream = stream
+        self.segment_dir = segment_dir
+        self.max_memory = max_memory
+        self.segment_size = segment_size
+        os.makedirs(segment_dir, exist_ok=True)
+        # The segments of a previous daemon on the same dir are kept,
+        # e.g. across a restart, and it can still be writing them.
+        self.prefix = "log-{}-{}".format(os.getpid(), next(_sink_ids))
+        self.segment_index = 0
+        self.segment: Optional[gzip.GzipFile] = None
+        self.segment_bytes = 0
+
+        self.lock = threading.Lock()
+        self.lines: Deque[str] = collections.deque()
+        self.memory = 0
+        # Number of lines read so far, and when the window started
+        self.count = 0
+        self.window_start = 0
+        # The line where the last bookmark() was set, and its label
+        self.bookmark_at: Optional[Tuple[int, str]] = None
+
+        self.thread = threading.Thread(
+            target=self.__run, name="lnprototest-log", daemon=True
+        )
+        self.thread.start()
+
+    def __write_segment(self, line: bytes) -> None:
+        if self.segment is None or self.segment_bytes >= self.segment_size:
+            if self.segment is not None:
+                self.segment.close()
+            path = os.path.join(
+                self.segment_dir,
+                "{}.{:04d}.gz".format(self.prefix, self.segment_index),
+            )
+            self.segment_index += 1
+            self.segment = gzip.open(path, "wb", compresslevel=1)
+            self.segment_bytes = 0
+        self.segment.write(line)
+        self.segment_bytes += len(line)
+
+    def __keep(self, raw: bytes) -> None:
+        line = raw.decode("utf-8", errors="replace")
+        with self.lock:
+            self.lines.append(line)
+            self.memory += len(line)
+            self.count += 1
+            while self.memory > self.max_memory and len(self.lines) > 1:
+                self.memory -= len(self.lines.popleft())
+
+    def __close_segment(self) -> None:
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    def __run(self) -> None:
+        write_segments = True
+        try:
+            for raw in iter(self.stream.readline, b""):
+                if write_segments:
+                    try:
+                        self.__write_segment(raw)
+                    except OSError as ex:
+                        logging.warning(f"log sink: not writing segments: {ex}")
+                        write_segments = False
+                        self.__close_segment()
+                self.__keep(raw)
+        except (OSError, ValueError) as ex:
+            logging.warning(f"log sink: dropping the rest of the log: {ex}")
+            try:
+                while self.stream.read(1 << 16):
+                    pass
+            except (OSError, ValueError) as ex:
+                logging.debug(f"log sink stopped: {ex}")
+        finally:
+            try:
+                self.__close_segment()
+            except OSError as ex:
+                logging.debug(f"log sink: closing the segment: {ex}")
+
+    def mark(self) -> None:
+        """Start a new window"""
+        with self.lock:
+            self.window_start = self.count
+
+    def bookmark(self, label: str) -> None:
+        """Note that label (e.g. the event being run) starts here"""
+        with self.lock:
+            self.bookmark_at = (self.count, label)
+
+    def window(self) -> List[str]:
+        """The lines since the last mark() which are still in memory,
+        with the last bookmark among them"""
+        with self.lock:
+            in_window = self.count - self.window_start
+            lines = list(self.lines)[-in_window:] if in_window else []
+            dropped = in_window - len(lines)
+            if self.bookmark_at is not None:
+                at, label = self.bookmark_at
+                pos = len(lines) - (self.count - at)
+                if at >= self.window_start and pos >= 0:
+                    lines.insert(pos, "[--- {} starts here ---]\n".format(label))
+            if dropped > 0:
+                lines.insert(
+                    0,
+                    "[... {} lines dropped, see {}]\n".format(
+                        dropped, self.segment_dir
+                    ),
+                )
+            return lines
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        """Wait for the daemon to close its end, and flush the segment"""
+        self.thread.join(timeout)
+
+
+def test_log_sink() -> None:
+    import tempfile
+    import time
+
+    rfd, wfd = os.pipe()
+    segment_dir = os.path.join(tempfile.mkdtemp(prefix="lnpt-log-"), "logs")
+    sink = LogSink(os.fdopen(rfd, "rb"), segment_dir, max_memory=30, segment_size=20)
+    with os.fdopen(wfd, "wb") as w:
+        w.write(b"first pass\n")
+        w.flush()
+        while sink.count < 1:
+            time.sleep(0.01)
+        sink.mark()
+        for i in range(3):
+            w.write("line {}\n".format(i).encode())
+        w.flush()
+        while sink.count < 4:
+            time.sleep(0.01)
+        sink.bookmark("failing event")
+        for i in range(3, 5):
+            w.write("line {}\n".format(i).encode())
+    sink.close()
+
+    # Only the last 30 bytes are in memory
+    assert sink.window() == [
+        "[... 1 lines dropped, see {}]\n".format(segment_dir),
+        "line 1\n",
+        "line 2\n",
+        "[--- failing event starts here ---]\n",
+        "line 3\n",
+        "line 4\n",
+    ]
+    # ...but everything is on disk
+    content = b""
+    for name in sorted(os.listdir(segment_dir)):
+        with gzip.open(os.path.join(segment_dir, name)) as f:
+            content += f.read()
+    assert content == b"first pass\n" + b"".join(
+        "line {}\n".format(i).encode() for i in range(5)
+    )
+    assert len(os.listdir(segment_dir)) == 2
+
+    # The sink of a restarted daemon doesn't overwrite them
+    rfd, wfd = os.pipe()
+    sink = LogSink(os.fdopen(rfd, "rb"), segment_dir)
+    with os.fdopen(wfd, "wb") as w:
+        w.write(b"restarted\n")
+    sink.close()
+    assert len(os.listdir(segment_dir)) == 3
+
+
+def test_log_sink_write_error() -> None:
+    import tempfile
+
+    rfd, wfd = os.pipe()
+    segment_dir = os.path.join(tempfile.mkdtemp(prefix="lnpt-log-"), "logs")
+    sink = LogSink(os.fdopen(rfd, "rb"), segment_dir, max_memory=100)
+    # No room for the segments anymore
+    os.rmdir(segment_dir)
+    with os.fdopen(wfd, "wb") as w:
+        # Way more than the pipe buffer: it blocks if nobody reads it
+        for i in range(100000):
+            w.write("line {}\n".format(i).encode())
+    sink.close(timeout=30)
+    assert not sink.thread.is_alive()
+    assert sink.window()[-1] == "line 99999\n"
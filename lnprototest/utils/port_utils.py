@@ -0,0 +1,148 @@
+"""
+Port allocation shared by all the test processes running on the machine.
+
+Binding port 0 and closing the socket gives a port that was free a moment
+ago, but with many pytest-xdist workers starting daemons at the same time
+two of them can be handed the same port. Here every port is leased by
+holding a flock() on a per-port file in the lnprototest cache, so the
+kernel drops the lease as soon as the owner process dies, and the ports
+are picked below the Linux ephemeral range, where the kernel doesn't
+hand them out to outgoing connections.
+"""
+
+import os
+import random
+import socket
+import threading
+import logging
+
+from contextlib import closing
+from typing import Dict
+
+from .fs_utils import cache_dir
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # type: ignore
+
+PORT_RANGE = (20000, 32000)
+
+# key == port, value == fd of the lease file we hold the lock on
+_leases: Dict[int, int] = {}
+_leases_lock = threading.Lock()
+
+
+def _is_free(port: int) -> bool:
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        try:
+            s.bind(("127.0.0.1", port))
+        except OSError:
+            return False
+    return True
+
+
+def _try_lease(port: int) -> bool:
+    path = os.path.join(cache_dir("ports"), str(port))
+    fd = os.open(path, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    if not _is_free(port):
+        # Not one of ours, but used by someone else.
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        return False
+    _leases[port] = fd
+    return True
+
+
+def reserve_port() -> int:
+    """Lease a free port, until release_port() or the end of the process"""
+    if fcntl is None:
+        # No flock(), fallback to asking a free port to the OS.
+        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+            s.bind(("", 0))
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            return s.getsockname()[1]
+
+    lo, hi = PORT_RANGE
+    start = random.randrange(lo, hi)
+    with _leases_lock:
+        for i in range(hi - lo):
+            port = lo + (start - lo + i) % (hi - lo)
+            if port not in _leases and _try_lease(port):
+                logging.debug(f"Leased port {port}")
+                return port
+    raise RuntimeError("No free port left in {}".format(PORT_RANGE))
+
+
+def release_port(port: int) -> None:
+    """Give back a port obtained with reserve_port()"""
+    with _leases_lock:
+        fd = _leases.pop(port, None)
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+def _forget_leases() -> None:
+    # A thread of the parent could hold the lock at fork() time, and the
+    # leases are the parent's: unlocking them here would give them away.
+    global _leases_lock
+    _leases_lock = threading.Lock()
+    for fd in _leases.values():
+        # Closing our copy keeps the lock, the parent still holds it.
+        os.close(fd)
+    _leases.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_leases)
+
+
+def test_reserve_port() -> None:
+    a = reserve_port()
+    b = reserve_port()
+    assert a != b
+    if fcntl is None:
+        return
+
+    # Another process (or file description) can't lease it meanwhile
+    fd = os.open(os.path.join(cache_dir("ports"), str(a)), os.O_RDWR)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            assert False, "port {} was not leased".format(a)
+        except BlockingIOError:
+            pass
+        release_port(a)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    finally:
+        os.close(fd)
+    release_port(b)
+
+
+def test_reserve_port_after_fork() -> None:
+    if fcntl is None or not hasattr(os, "fork"):
+        return
+    port = reserve_port()
+    pid = os.fork()
+    if pid == 0:
+        # The child can neither take nor give back the port of its parent
+        ok = port not in _leases and not _try_lease(port)
+        release_port(port)
+        os._exit(0 if ok and reserve_port() != port else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert port in _leases
+    fd = os.open(os.path.join(cache_dir("ports"), str(port)), os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        assert False, "port {} was given away by the child".format(port)
+    except BlockingIOError:
+        pass
+    finally:
+        os.close(fd)
+    release_port(port)
@@ -2,6 +2,8 @@
 Utils module that implement common function used across lnprototest library.
 """
 
+import copy
+import copyreg
 import string
 import coincurve
 import time
@@ -12,9 +14,33 @@ import traceback
 from typing import Union, Sequence, List
 from enum import IntEnum
 
+from bitcoin.core.serialize import ImmutableSerializable
 from lnprototest.keyset import KeySet
 
 
+# coincurve keys wrap a cffi pointer, which can't be copied or pickled:
+# rebuild them from their serialization instead.
+copyreg.pickle(coincurve.PrivateKey, lambda k: (coincurve.PrivateKey, (k.secret,)))
+copyreg.pickle(coincurve.PublicKey, lambda k: (coincurve.PublicKey, (k.format(),)))
+
+
+def _register_immutables(cls: type) -> None:
+    # python-bitcoinlib immutable objects refuse setattr, so they can't be
+    # rebuilt field by field.
+    sub: type
+    for sub in cls.__subclasses__():
+        copyreg.pickle(sub, lambda o: (type(o).deserialize, (o.serialize(),)))
+        _register_immutables(sub)
+
+
+_register_immutables(ImmutableSerializable)
+
+
+def copy_state(state: typing.Any) -> typing.Any:
+    """Deep copy of the runner state (e.g. the stash), keys included"""
+    return copy.deepcopy(state)
+
+
 class Side(IntEnum):
     local = 0
     remote = 1
@@ -66,9 +92,10 @@ def gen_random_keyset(counter: int = 20) -> KeySet:
     )
 
 
-def wait_for(success: typing.Callable, timeout: int = 180) -> None:
+def wait_for(
+    success: typing.Callable, timeout: float = 180, interval: float = 0.25
+) -> None:
     start_time = time.time()
-    interval = 0.25
     while not success():
         time_left = start_time + timeout - time.time()
         if time_left <= 0: